@@ -6,7 +6,7 @@ from django.utils.safestring import mark_safe
 from django.core.exceptions import ValidationError
 from constance import config
 
-from .models import (SongLyrics, SongRequest, Singer, GroupSongRequest, TicketOrder,
+from .models import (LibraryLyrics, SongLyrics, SongRequest, Singer, GroupSongRequest, TicketOrder,
                      CurrentGroupSong, TriviaQuestion, TriviaResponse, Celebration
 )
 from .forms import SongRequestForm
@@ -36,12 +36,14 @@ def set_solo_skipped(modeladmin, request, queryset):
     for song in queryset:
         song.skipped = True
         song.save()
+    Singer.ordering.refresh_snapshots()
 
 
 def set_solo_unskipped(modeladmin, request, queryset):
     for song in queryset:
         song.skipped = False
         song.save()
+    Singer.ordering.refresh_snapshots()
 
 
 set_solo_skipped.short_description = 'Mark song as skipped'
@@ -81,14 +83,14 @@ unset_standby.allowed_permissions = ['change']
 
 def force_lyrics_refresh(modeladmin, request, queryset):
     for song in queryset:
-        get_lyrics.delay(song_id=song.id)
+        get_lyrics.delay(song_id=song.id, refresh=True)
 
 force_lyrics_refresh.short_description = "Force lyrics refresh"
 force_lyrics_refresh.allowed_permissions = ['change']
 
 def force_group_lyrics_refresh(modeladmin, request, queryset):
     for song in queryset:
-        get_lyrics.delay(group_song_id=song.id)
+        get_lyrics.delay(group_song_id=song.id, refresh=True)
 
 force_group_lyrics_refresh.short_description = "Force lyrics refresh"
 force_group_lyrics_refresh.allowed_permissions = ['change']
@@ -254,6 +256,10 @@ class SongRequestAdmin(admin.ModelAdmin):
 
         return super().changelist_view(request, extra_context=extra_context)
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        Singer.ordering.refresh_snapshots()  # Edits to the song (partners, skipped) might change singers' dashboards
+
     def has_delete_permission(self, request, obj=None):
         return False
 
@@ -380,6 +386,14 @@ class LyricsAdmin(admin.ModelAdmin):
     link.short_description = "Link"
 
 
+@admin.register(LibraryLyrics)
+class LibraryLyricsAdmin(admin.ModelAdmin):
+    list_display = ['song_name', 'musical', 'lyrics_song_name', 'artist_name', 'default', 'url']
+    list_filter = ('default',)
+    search_fields = ('song_name', 'musical')
+    list_per_page = 500
+
+
 @admin.register(TicketOrder)
 class OrdersAdmin(admin.ModelAdmin):
     list_display = ['order_id', 'event_name', 'event_sku', 'num_tickets', 'ticket_type', 'customer_name',
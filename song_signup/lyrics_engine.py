@@ -0,0 +1,43 @@
+"""
+Runs all the lyrics providers (parsers) of a song concurrently, in a single worker.
+The parsers do blocking I/O (requests sessions, the sherlock throttle), so each provider runs in a thread of its own
+and the parsers keep their API - the event loop only schedules them, limiting how many run at once per site and
+overall.
+"""
+import asyncio
+from collections import defaultdict
+from logging import getLogger
+
+from django.db import connection
+
+logger = getLogger(__name__)
+
+SITE_CONCURRENCY = 1  # Providers of the same site run one after the other, on top of the per-request throttle
+MAX_CONCURRENT_PROVIDERS = 8
+
+
+def _in_thread(fetch, *args):
+    # Each thread opens its own DB connection - close it with the thread, rather than leak it
+    try:
+        fetch(*args)
+    finally:
+        connection.close()
+
+
+async def run_providers(providers, fetch):
+    """
+    Call fetch(provider, *args) for each provider, concurrently.
+    `providers` - {provider: (site, args)}. A provider that fails is logged, and doesn't stop the others.
+    """
+    site_limits = defaultdict(lambda: asyncio.Semaphore(SITE_CONCURRENCY))
+    limit = asyncio.Semaphore(MAX_CONCURRENT_PROVIDERS)
+
+    async def run(provider, site, args):
+        async with limit, site_limits[site]:
+            await asyncio.to_thread(_in_thread, fetch, provider, *args)
+
+    results = await asyncio.gather(*(run(provider, site, args) for provider, (site, args) in providers.items()),
+                                   return_exceptions=True)
+    for provider, result in zip(providers, results):
+        if isinstance(result, Exception):
+            logger.error(f"Lyrics provider {provider} failed", exc_info=result)
@@ -0,0 +1,122 @@
+"""
+The current lyrics are the largest polled response, so their JSON is serialized and compressed once per lyrics, and
+served as is (with the matching Content-Encoding) until the lyrics change.
+The drinking words are highlighted here too, once per lyrics and drinking words, rather than by the lyrics screen.
+"""
+import gzip
+import hashlib
+import json
+import re
+
+import brotli
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import patch_vary_headers
+
+from twist.utils import get_redis
+
+from .serializers import LyricsSerializer
+
+PAYLOAD_TIMEOUT = 60 * 60 * 24  # Seconds - lyrics stay current for a song at most, this only cleans up
+IDENTITY = 'identity'
+ENCODINGS = ('br', 'gzip')  # In order of preference
+ALL_WORDS = '*'  # Drink on every word
+
+
+def _utf16_length(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+def drinking_spans(text, drinking_words):
+    """
+    [start, end) of every drinking word (or its plural) in the text, as indices of a JS string (UTF-16 code units) so
+    the client can slice the lyrics with them as is.
+    """
+    words = [word for word in drinking_words if word]
+    if not words:
+        return []
+
+    if ALL_WORDS in words:
+        pattern = r"\b[\w']+\b"
+    else:
+        # Longest first, so a word is highlighted whole even when another word is its prefix
+        alternatives = '|'.join(f'{re.escape(word)}s?' for word in sorted(words, key=len, reverse=True))
+        pattern = rf'\b(?:{alternatives})\b'
+
+    spans = []
+    position = js_position = 0
+    for match in re.finditer(pattern, text, re.IGNORECASE):
+        start = js_position + _utf16_length(text[position:match.start()])
+        js_position = start + _utf16_length(match.group())
+        position = match.end()
+        spans.append([start, js_position])
+    return spans
+
+
+def lyrics_hash(lyrics, is_group_song, drinking_words):
+    """Identifies the payload - changes with the lyrics, their content (when edited), or the drinking words"""
+    content = '\0'.join([str(lyrics.id), lyrics.song_name, lyrics.artist_name, lyrics.lyrics, str(is_group_song),
+                         *drinking_words])
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def _build_payloads(lyrics, is_group_song, drinking_words, payload_hash):
+    data = LyricsSerializer(lyrics, read_only=True, context={'is_group_song': is_group_song}).data
+    data['drinking_spans'] = drinking_spans(lyrics.lyrics, drinking_words)
+    data['hash'] = payload_hash
+    body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+    return {
+        IDENTITY: body,
+        'gzip': gzip.compress(body),
+        'br': brotli.compress(body, mode=brotli.MODE_TEXT),
+    }
+
+
+def _quality(params):
+    for param in params:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+    return 1.0
+
+
+def accepted_encoding(request):
+    """The encoding the client prefers (by q-value, then ours) among ours - never one it refuses with q=0"""
+    qualities = {}
+    for encoding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, *params = encoding.split(';')
+        if name.strip():
+            qualities[name.strip().lower()] = _quality(params)
+
+    any_quality = qualities.get('*', 0.0)
+    accepted = [encoding for encoding in ENCODINGS if qualities.get(encoding, any_quality) > 0]
+    return max(accepted, key=lambda encoding: qualities.get(encoding, any_quality), default=IDENTITY)
+
+
+def lyrics_response(request, lyrics, is_group_song, drinking_words):
+    """
+    The lyrics payload, or just {"unchanged": true} when the client says (with ?hash=) it already has it - which is
+    what the lyrics screen gets on every stage change but a new song.
+    """
+    payload_hash = lyrics_hash(lyrics, is_group_song, drinking_words)
+    if request.GET.get('hash') == payload_hash:
+        return JsonResponse({'unchanged': True})
+
+    encoding = accepted_encoding(request)
+    key = f'lyrics:payload:{payload_hash}'
+
+    redis = get_redis()
+    body = redis.hget(key, encoding)
+    if body is None:
+        payloads = _build_payloads(lyrics, is_group_song, drinking_words, payload_hash)
+        redis.hset(key, mapping=payloads)
+        redis.expire(key, PAYLOAD_TIMEOUT)
+        body = payloads[encoding]
+
+    response = HttpResponse(body, content_type='application/json')
+    if encoding != IDENTITY:
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
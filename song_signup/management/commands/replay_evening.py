@@ -0,0 +1,283 @@
+import csv
+import glob
+import os
+import statistics
+import threading
+import time
+from collections import defaultdict
+from unittest.mock import patch
+
+from constance import config
+from constance.test import override_config
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from flags.state import enable_flag
+
+from song_signup.models import GroupSongRequest, Singer, SongRequest, TicketOrder, SING_SKU
+from song_signup.tasks import get_lyrics, recalculate_positions
+from song_signup.views import _sanitize_string, name_to_username
+from twist.utils import get_redis
+
+DEFAULT_SETLISTS = os.path.join(settings.BASE_DIR, 'song_lists', 'bwt-*.csv')
+DEFAULT_OUTPUT = 'replay-results.csv'
+REPLAY_SKU = 'REPLAY'
+REPLAY_PASSCODE = 'replay'
+REPLAY_ORDER_ID = 1
+REPLAY_REDIS_DB = 15  # Not the app's - the replay's stage versions, caches and config never reach the running app
+GROUP_SONG = 'Group Song'
+SLOT_SECONDS = 240  # About the length of a song, including the changeover
+POLL_INTERVAL = 1000  # ms, until the server says otherwise (X-Poll-Interval)
+
+# Event kinds, in the order they happen when scheduled for the same slot
+LOGIN, SIGNUP, PERFORM, GROUP_SONG_SLOT = range(4)
+
+
+def _split_name(full_name):
+    first_name, _, last_name = full_name.strip().partition(' ')
+    return _sanitize_string(first_name), _sanitize_string(last_name)
+
+
+def build_stream(rows, lead):
+    """
+    Turn a setlist (rows of singers, song, musical - in the order they were performed) into a timed list of events.
+    The setlists only keep the order of the evening, so its timeline is in slots - each row of the setlist is
+    performed in its own slot. Every singer logs in `lead` slots before their first appearance and signs up with their
+    first song, and signs up with their next song right after performing.
+    Returns a list of (slot, kind, payload) tuples, in the order they should be replayed.
+    """
+    events = []
+    first_appearance = {}
+    songs_by_singer = defaultdict(list)
+
+    for slot, (singers, song_name, musical) in enumerate(rows):
+        if singers == GROUP_SONG:
+            events.append((slot, GROUP_SONG_SLOT, (song_name, musical)))
+            continue
+
+        primary, *partners = [name.strip() for name in singers.split(' and ')]
+        for name in [primary, *partners]:
+            first_appearance.setdefault(name, slot)
+
+        song = (primary, partners, song_name, musical)
+        songs_by_singer[primary].append((slot, song))
+        events.append((slot, PERFORM, song))
+
+    for name, slot in first_appearance.items():
+        events.append((max(slot - lead, 0) - 0.5, LOGIN, name))
+
+    for name, songs in songs_by_singer.items():
+        signup_slot = first_appearance[name] - lead - 0.5
+        for slot, song in songs:
+            events.append((max(signup_slot, -0.5), SIGNUP, song))
+            signup_slot = slot + 0.5  # The next song is requested right after performing this one
+
+    return sorted(events, key=lambda event: (event[0], event[1]))
+
+
+class Command(BaseCommand):
+    help = ("Replay historical evenings from the song_lists setlists through the real views, and record the latency "
+            "and query count of every operation. Events are replayed at their times in the evening (a slot per song, "
+            "sped up by --speed), with the lyrics screen polling in between and lineup recalculations debounced as "
+            "on the celery worker. The evenings are replayed on a scratch database - a test database (test_<NAME>), "
+            "created with Django's test database machinery, flushed before each evening and dropped at the end - and "
+            "on a Redis DB of their own, committing as the app does, so it's safe to run next to a running app.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('setlists', type=str, nargs='*', help="Setlist CSV files (all of song_lists by default)")
+        parser.add_argument('--output', type=str, default=DEFAULT_OUTPUT, help="Where to write the results CSV")
+        parser.add_argument('--lead', type=int, default=5,
+                            help="How many slots before their first performance singers log in")
+        parser.add_argument('--slot-seconds', type=float, default=SLOT_SECONDS, help="The length of a slot")
+        parser.add_argument('--speed', type=float, default=60,
+                            help="How many times faster than the evening to replay it (0 - without waiting at all)")
+        parser.add_argument('--debounce', type=float, default=settings.LINEUP_RECALC_DEBOUNCE,
+                            help="LINEUP_RECALC_DEBOUNCE for the replay (0 recalculates within the requests)")
+
+    def handle(self, *args, **options):
+        setlists = options['setlists'] or sorted(glob.glob(DEFAULT_SETLISTS))
+        results = []
+
+        # Lyrics are out of scope
+        with override_settings(LINEUP_RECALC_DEBOUNCE=options['debounce'], REDIS_DB=REPLAY_REDIS_DB), \
+                patch.object(get_lyrics, 'delay'):
+            get_redis.cache_clear()
+            redis = get_redis()
+            test_db_name = old_db_name = connection.settings_dict['NAME']
+            try:
+                with patch.object(config._backend, '_rd', redis):
+                    test_db_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+                    for setlist in setlists:
+                        results.extend(self._replay(setlist, redis, options))
+            finally:
+                if test_db_name != old_db_name:
+                    connection.creation.destroy_test_db(old_db_name, verbosity=0)
+                redis.flushdb()
+                get_redis.cache_clear()
+
+        with open(options['output'], 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['evening', 'step', 'operation', 'status', 'duration_ms', 'queries'])
+            writer.writerows(results)
+
+        self._write_summary(results)
+        self.stdout.write(f"Results written to {options['output']}")
+
+    def _replay(self, setlist, redis, options):
+        with open(setlist, newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)  # Skip the headers
+            rows = [row[1:4] for row in reader if len(row) >= 4 and row[1].strip()]
+
+        # Every evening starts from an empty database and Redis
+        call_command('flush', interactive=False, verbosity=0)
+        redis.flushdb()
+        with override_config(PASSCODE=REPLAY_PASSCODE, EVENT_SKU=REPLAY_SKU):
+            evening = os.path.basename(setlist)
+            self.stdout.write(f"Replaying {evening} ({len(rows)} songs)")
+            return Replay(evening).run(build_stream(rows, options['lead']),
+                                       slot_seconds=options['slot_seconds'] / options['speed'] if options['speed'] else 0)
+
+    def _write_summary(self, results):
+        by_operation = defaultdict(list)
+        for _, _, operation, _, duration, queries in results:
+            by_operation[operation].append((duration, queries))
+
+        self.stdout.write(f"{'operation':<20} {'count':>6} {'mean ms':>8} {'p95 ms':>8} {'max ms':>8} {'queries':>8}")
+        for operation, measurements in sorted(by_operation.items()):
+            durations = [duration for duration, _ in measurements]
+            p95 = statistics.quantiles(durations, n=20, method='inclusive')[-1] if len(durations) > 1 \
+                else durations[0]
+            self.stdout.write(f"{operation:<20} {len(measurements):>6} {statistics.mean(durations):>8.2f} "
+                              f"{p95:>8.2f} {max(durations):>8.2f} "
+                              f"{statistics.mean(queries for _, queries in measurements):>8.1f}")
+
+
+class Replay:
+    def __init__(self, evening):
+        self.evening = evening
+        self.results = []
+        self.clients = {}  # Singer name -> logged in client
+        self.songs = {}  # (primary singer, song name) -> SongRequest pk
+        self.admin = Client()
+        self.lock = threading.Lock()  # Recalculations record their results from their own threads
+        self.recalculations = []
+
+    def run(self, stream, slot_seconds):
+        """`slot_seconds` - how long to replay a slot of the evening in (0 - replay without waiting)"""
+        self._setup(num_singers=sum(kind == LOGIN for _, kind, _ in stream))
+        started = time.monotonic()
+        first_slot = stream[0][0] if stream else 0
+
+        with patch.object(recalculate_positions, 'apply_async', self._schedule_recalculation):
+            for slot, kind, payload in stream:
+                if slot_seconds:
+                    self._wait_until(started + (slot - first_slot) * slot_seconds)
+                {LOGIN: self._login, SIGNUP: self._signup,
+                 PERFORM: self._perform, GROUP_SONG_SLOT: self._group_song}[kind](payload)
+
+            for recalculation in self.recalculations:
+                recalculation.join()
+        return self.results
+
+    def _wait_until(self, due):
+        """Poll the stage state in the meantime, as a phone would - at the interval the server tells it to"""
+        while time.monotonic() < due:
+            client = next(iter(self.clients.values()), self.admin)
+            response = self._request('stage_state', client, 'get', reverse('stage_state'))
+            interval = int(response.get('X-Poll-Interval', POLL_INTERVAL)) / 1000
+            time.sleep(max(0, min(interval, due - time.monotonic())))
+
+    def _schedule_recalculation(self, countdown=0, **kwargs):
+        # In place of the celery worker, which would recalculate the app's lineup rather than the scratch database's
+        recalculation = threading.Timer(countdown, self._recalculate)
+        self.recalculations.append(recalculation)
+        recalculation.start()
+
+    def _recalculate(self):
+        try:
+            started = time.perf_counter()
+            with CaptureQueriesContext(connection) as queries:
+                recalculate_positions()
+            self._record('recalculate_positions', '', (time.perf_counter() - started) * 1000, len(queries))
+        finally:
+            connection.close()  # The thread's own connection
+
+    def _setup(self, num_singers):
+        enable_flag('CAN_SIGNUP')
+        TicketOrder.objects.create(order_id=REPLAY_ORDER_ID, event_sku=REPLAY_SKU, event_name=self.evening,
+                                   num_tickets=num_singers, customer_name='Replay', ticket_type=SING_SKU)
+        self.admin.force_login(Singer.objects.create_superuser(username='replay_admin', password='replay'))
+
+    def _request(self, operation, client, method, url, data=None):
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(client, method)(url, data)
+        duration = (time.perf_counter() - started) * 1000
+
+        self._record(operation, response.status_code, duration, len(queries))
+        return response
+
+    def _record(self, operation, status, duration, queries):
+        with self.lock:
+            self.results.append([self.evening, len(self.results) + 1, operation, status, round(duration, 2), queries])
+
+    def _login(self, name):
+        if name in self.clients:
+            return
+
+        client = Client()
+        first_name, last_name = _split_name(name)
+        self._request('login', client, 'post', reverse('login'), {
+            'ticket-type': 'singer', 'first-name': first_name, 'last-name': last_name,
+            'passcode': REPLAY_PASSCODE, 'order-id': REPLAY_ORDER_ID, 'no-upload': 'on'
+        })
+        self.clients[name] = client
+
+    def _singer(self, name):
+        return Singer.objects.get(username=name_to_username(*_split_name(name)))
+
+    def _signup(self, song):
+        primary, partners, song_name, musical = song
+        for name in [primary, *partners]:
+            self._login(name)
+
+        response = self._request('add_song_request', self.clients[primary], 'post', reverse('add_song_request'), {
+            'song-name': song_name, 'musical': musical, 'approve-duplicate': 'on',
+            'partners': [self._singer(partner).pk for partner in partners]
+        })
+        if response.status_code == 200:
+            latest = SongRequest.objects.filter(singer=self._singer(primary)).order_by('-pk').first()
+            self.songs[(primary, song_name)] = latest.pk
+
+    def _perform(self, song):
+        primary, _, song_name, _ = song
+        song_pk = self.songs.get((primary, song_name))
+        if song_pk is None:  # The signup was rejected
+            return
+
+        self._request('set_performed', self.admin, 'post', reverse('admin:song_signup_songrequest_changelist'),
+                      {'action': 'set_solo_performed', '_selected_action': [song_pk]})
+        self._stage_screens()
+        self._request('dashboard_data', self.clients[primary], 'get', reverse('dashboard_data'))
+
+    def _group_song(self, song):
+        song_name, musical = song
+        group_song, _ = GroupSongRequest.objects.get_or_create(song_name=song_name, musical=musical,
+                                                               defaults={'type': 'REGULAR'})
+
+        self._request('prepare_group_song', self.admin, 'post',
+                      reverse('admin:song_signup_groupsongrequest_changelist'),
+                      {'action': 'prepare_group_song', '_selected_action': [group_song.pk]})
+        self._request('start_group_song', self.admin, 'get', reverse('start_group_song'))
+        self._stage_screens()
+        self._request('end_group_song', self.admin, 'get', reverse('end_group_song'))
+
+    def _stage_screens(self):
+        # What the lineup and spotlight screens poll after every change on stage
+        self._request('spotlight_data', self.admin, 'get', reverse('spotlight_data'))
+        self._request('get_lineup', self.admin, 'get', reverse('get_lineup'))
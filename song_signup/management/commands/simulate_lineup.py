@@ -0,0 +1,78 @@
+import itertools
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+
+from song_signup.ordering import SingerRecord, SongRecord, calculate_lineup
+
+DEFAULT_SIZES = [50, 500, 5000]
+SONGS_PER_SINGER = 3
+RAFFLE_WINNERS_RATIO = 0.05
+STANDBY_RATIO = 0.05
+CLOSE_SIGNUP_AT = 0.7  # Part of the evening after which the signup is closed
+
+
+class Command(BaseCommand):
+    help = "Replay synthetic evenings through the lineup algorithm, and report the time each recalculation takes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('sizes', type=int, nargs='*', default=DEFAULT_SIZES,
+                            help="Number of singers in each simulated evening")
+        parser.add_argument('--recalcs', type=int, default=200,
+                            help="Number of recalculations (signups and performances) in each evening")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+
+        self.stdout.write(f"{'singers':>8} {'songs':>7} {'recalcs':>8} {'mean ms':>8} {'p95 ms':>8} {'max ms':>8}")
+        for size in options['sizes']:
+            timings, num_songs = self._simulate_evening(size, options['recalcs'])
+            p95 = statistics.quantiles(timings, n=20, method='inclusive')[-1] if len(timings) > 1 \
+                else timings[0]
+            self.stdout.write(f"{size:>8} {num_songs:>7} {len(timings):>8} {statistics.mean(timings):>8.2f} "
+                              f"{p95:>8.2f} {max(timings):>8.2f}")
+
+    def _simulate_evening(self, num_singers, num_recalcs):
+        """
+        Half of the singers are already in line when the evening starts, and the rest sign up throughout it.
+        Between signups, the singer at the top of the lineup performs and moves to the back.
+        """
+        start = datetime(year=2024, month=1, day=1)
+        clock = (start + timedelta(seconds=second) for second in itertools.count())
+        song_pks = itertools.count(1)
+
+        singers = {}
+        songs = {}
+        waiting = list(range(1, num_singers + 1))
+
+        def sign_up(singer_pk):
+            singers[singer_pk] = SingerRecord(pk=singer_pk, first_request_at=next(clock),
+                                              is_audience=random.random() < RAFFLE_WINNERS_RATIO)
+            for priority in range(1, random.randint(1, SONGS_PER_SINGER) + 1):
+                song_pk = next(song_pks)
+                songs[song_pk] = SongRecord(pk=song_pk, singer_pk=singer_pk, priority=priority,
+                                            standby=random.random() < STANDBY_RATIO)
+
+        for singer_pk in waiting[:num_singers // 2]:
+            sign_up(singer_pk)
+        waiting = waiting[num_singers // 2:]
+
+        timings = []
+        for recalc in range(num_recalcs):
+            can_signup = recalc < num_recalcs * CLOSE_SIGNUP_AT
+
+            started = time.perf_counter()
+            positions = calculate_lineup(singers.values(), songs.values(), can_signup)
+            timings.append((time.perf_counter() - started) * 1000)
+
+            if recalc % 2 and can_signup and waiting:
+                sign_up(waiting.pop())
+            elif positions:
+                current_song = songs.pop(min(positions, key=positions.get))
+                singers[current_song.singer_pk].last_performance_at = next(clock)
+
+        return timings, next(song_pks) - 1
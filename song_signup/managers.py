@@ -3,10 +3,32 @@ from itertools import chain
 from django.contrib.auth.models import UserManager
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
-from django.db.models import Manager, Max
+from django.db.models import Case, IntegerField, Manager, Max, Min, Q, Value, When
 from django.utils import timezone
+from django.conf import settings
 from flags.state import flag_enabled
 
+from song_signup.ordering import SingerRecord, SongRecord, assign_positions, next_songs, order_singers
+from song_signup.stage import bump_stage_version
+from twist.utils import advisory_lock, get_redis
+
+# Set while a recalculation is scheduled and hasn't started yet. Expires on its own in case the task is lost.
+RECALC_PENDING_KEY = 'lineup:recalc-pending'
+RECALC_PENDING_TIMEOUT = 10  # seconds
+
+LINEUP_LOCK = 'lineup:recalculation'
+
+
+def position_changes(current_positions, new_positions):
+    """
+    Compare the lineup as it is in the DB with the newly calculated one (both are dicts of song pk -> position).
+    Returns the pks of songs that dropped out of the lineup, and the pks of songs whose position changed.
+    """
+    unscheduled = [song_pk for song_pk, position in current_positions.items()
+                   if position is not None and song_pk not in new_positions]
+    moved = [song_pk for song_pk, position in new_positions.items() if current_positions.get(song_pk) != position]
+    return unscheduled, moved
+
 
 class SongSuggestionManager(Manager):
     def check_used_suggestions(self):
@@ -17,6 +39,44 @@ class SongSuggestionManager(Manager):
             suggestion.check_if_used()
 
 
+class LibraryLyricsManager(Manager):
+    def for_song(self, song):
+        from song_signup.models import _normalize_string
+
+        return self.filter(song_name=_normalize_string(song.song_name), musical=_normalize_string(song.musical))
+
+    def _lookup(self, song, lyrics):
+        """The library entry of the lyrics - the one of their page, or of their content when they have none"""
+        from song_signup.models import _normalize_string
+
+        lookup = dict(song_name=_normalize_string(song.song_name), musical=_normalize_string(song.musical),
+                      url=lyrics.url or None)
+        if not lyrics.url:
+            lookup['lyrics'] = lyrics.lyrics
+        return lookup
+
+    def add(self, song, lyrics):
+        """
+        The library entry of the lyrics, added if they're new. An existing entry is kept as is - it may be the default,
+        and the chosen lyrics may have been edited since they were fetched.
+        """
+        library_lyrics, _ = self.get_or_create(
+            **self._lookup(song, lyrics),
+            defaults=dict(lyrics_song_name=lyrics.song_name, artist_name=lyrics.artist_name, lyrics=lyrics.lyrics,
+                          default=lyrics.default),
+        )
+        return library_lyrics
+
+    def set_default(self, song, lyrics):
+        """The chosen lyrics (as edited) stay the song's default on later evenings too"""
+        self.for_song(song).update(default=False)
+        self.update_or_create(
+            **self._lookup(song, lyrics),
+            defaults=dict(lyrics_song_name=lyrics.song_name, artist_name=lyrics.artist_name, lyrics=lyrics.lyrics,
+                          default=True),
+        )
+
+
 class SongRequestManager(Manager):
     def reset_positions(self):
         self.all().update(position=None)
@@ -75,61 +135,169 @@ class DisneylandOrdering(UserManager):
     list. In order to allow latecomers to be able to sing, towards the end of the evening Shani will close the signup
     and we'll move to a mode in which only those who haven't sung yet get to sing.
     """
+    def _with_lineup_data(self, queryset):
+        """
+        Annotate each singer with the times the ordering is based on, so that the whole lineup can be resolved in a
+        single query instead of a few queries per singer. Only singers that requested at least one song are kept.
+        """
+        return queryset.filter(is_active=True).annotate(
+            first_request_at=Min('songs__request_time'),
+            last_performance_at=Max('songs__performance_time'),
+        ).filter(first_request_at__isnull=False)
+
+    def active_singers_queryset(self):
+        return self._with_lineup_data(self.filter(is_audience=False))
+
+    def active_raffle_winners_queryset(self):
+        return self._with_lineup_data(self.filter(is_audience=True, raffle_winner=True))
+
     def active_singers(self):
         """
         Return all logged-in singers that have at least one song request
         """
-        return [singer for singer in self.filter(is_audience=False) if singer.is_active
-                and singer.songs.filter(request_time__isnull=False).exists()]
+        return list(self.active_singers_queryset())
 
     def active_raffle_winners(self):
         """
         Return all logged-in raffle winners that already added their song
         """
-        return [singer for singer in self.filter(is_audience=True, raffle_winner=True) if singer.is_active
-                and singer.songs.filter(request_time__isnull=False).exists()]
+        return list(self.active_raffle_winners_queryset())
 
     def active_raffle_participants(self):
         """
         Return all logged-in raffle participants that didn't win yet
         """
-        return [singer for singer in self.filter(is_audience=True, raffle_participant=True, raffle_winner=False)
-                if singer.is_active]
+        return list(self.filter(is_audience=True, raffle_participant=True, raffle_winner=False, is_active=True))
 
     def new_singers_num(self):
-        return len([singer for singer in self.active_singers() if singer.all_songs.exists()
-                    and singer.last_performance_time is None])
+        return self.active_singers_queryset().filter(last_performance_at__isnull=True).count()
 
     def new_raffle_winners_num(self):
-        return len([singer for singer in self.active_raffle_winners() if singer.all_songs.exists()
-                    and singer.last_performance_time is None])
+        return self.active_raffle_winners_queryset().filter(last_performance_at__isnull=True).count()
+
+    def _lineup_songs(self):
+        """
+        Load the songs the lineup is calculated from, in a single query: every song that wasn't performed yet, and
+        every song that still holds a position (a song that was just performed has to be taken out of the lineup).
+        Returns the current positions (song pk -> position), and the records of the songs that weren't performed.
+        """
+        from song_signup.models import SongRequest
+
+        now = timezone.now()
+        current_positions = {}
+        pending_songs = {}
+        for (pk, singer_pk, priority, standby, skipped, placeholder, request_time, performance_time, position,
+             partner_pk) in SongRequest.objects.filter(
+                Q(performance_time__isnull=True) | Q(position__isnull=False)
+        ).order_by().values_list('pk', 'singer_id', 'priority', 'standby', 'skipped', 'placeholder', 'request_time',
+                                 'performance_time', 'position', 'partners'):
+            current_positions[pk] = position
+            if performance_time is not None:
+                continue
+
+            song = pending_songs.setdefault(pk, SongRecord(pk=pk, singer_pk=singer_pk, priority=priority,
+                                                           standby=standby, skipped=skipped, placeholder=placeholder,
+                                                           deferred=request_time > now))
+            if partner_pk is not None:
+                song.partner_pks.append(partner_pk)
+
+        return current_positions, list(pending_songs.values())
+
+    def _write_snapshots(self, songs, positions):
+        """
+        Persist the next song and wait amount of every singer, writing only the singers whose snapshot changed
+        """
+        from song_signup.models import LineupSnapshot
+
+        current_snapshots = {singer_pk: (song_pk, position, wait_amount) for singer_pk, song_pk, position, wait_amount
+                             in LineupSnapshot.objects.values_list('singer_id', 'song_id', 'position', 'wait_amount')}
+        new_snapshots = next_songs(songs, positions)
+
+        outdated = [singer_pk for singer_pk, snapshot in current_snapshots.items()
+                    if new_snapshots.get(singer_pk) != snapshot]
+        changed = {singer_pk for singer_pk, snapshot in new_snapshots.items()
+                   if current_snapshots.get(singer_pk) != snapshot}
+
+        if outdated or changed:
+            bump_stage_version()  # Bulk writes don't send the signals that bump it
+        if outdated:
+            LineupSnapshot.objects.filter(singer_id__in=outdated).delete()
+        if changed:
+            LineupSnapshot.objects.bulk_create([
+                LineupSnapshot(singer_id=singer_pk, song_id=song_pk, position=position, wait_amount=wait_amount)
+                for singer_pk, (song_pk, position, wait_amount) in new_snapshots.items() if singer_pk in changed
+            ])
 
     def calculate_positions(self):
+        """
+        Recalculate the lineup, writing only the songs whose position actually changed.
+        This is not incremental: every recalculation still loads and orders the whole lineup (one query, and sorting
+        in memory). Only the write is limited to the difference - a single UPDATE of the changed songs, instead of
+        nulling and re-saving every song. A signup near the end of the lineup changes a few rows, but a performance at
+        the top shifts every song after it, so it still rewrites the whole lineup (in that one statement).
+        Also updates every singer's lineup snapshot (their next song and wait amount).
+        """
         # Ignoring duets - only primary singer is relevant to the positioning.
         # Duet enforcement is now done in the Model - a singer can be a duetor in at most one song.
         from song_signup.models import SongRequest
 
-        with transaction.atomic():
-            # Serialize concurrent recalcs to avoid deadlocks: when many singers sign up at
-            # once, each recalc rewrites the whole position table, and two of them locking the
-            # same rows in different orders deadlock (Postgres aborts one -> the signup 500s).
-            # Locking every row up front in a single, consistent order (by pk) forces recalcs
-            # to queue instead of collide. Held until this atomic block commits.
-            list(SongRequest.objects.select_for_update().order_by('pk'))
+        # Serialize concurrent recalcs: each one computes the lineup from what the previous ones wrote, and two recalcs
+        # interleaving would write positions based on a stale lineup. The lock is only taken by recalcs, so other
+        # writes to songs (updating a song, toggling lyrics) don't wait for it.
+        with advisory_lock(LINEUP_LOCK):
+            current_positions, songs = self._lineup_songs()
+
+            singers = self.singer_disneyland_ordering()
+            new_positions = assign_positions([singer.pk for singer in singers], songs)
+            unscheduled, moved = position_changes(current_positions, new_positions)
 
-            SongRequest.objects.reset_positions()
+            # Write every change in a single UPDATE, bypassing SongRequest.save() - none of its hooks (titlecase,
+            # people's choice matching, priority) are relevant to a position change.
+            if unscheduled or moved:
+                bump_stage_version()
+                SongRequest.objects.filter(pk__in=unscheduled + moved).update(position=Case(
+                    *[When(pk=song_pk, then=Value(new_positions[song_pk])) for song_pk in moved],
+                    default=None,
+                    output_field=IntegerField()
+                ))
 
-            position = 1
-            scheduled_songs = []
-            for singer in self.singer_disneyland_ordering():
-                song_to_schedule = singer.songs.filter(performance_time__isnull=True, standby=False,
-                                                       request_time__lte=timezone.now()).order_by('priority').first()
-                if song_to_schedule:
-                    song_to_schedule.position = position
-                    song_to_schedule.save()
-                    scheduled_songs.append(song_to_schedule)
+            self._write_snapshots(songs, new_positions)
 
-                    position += 1
+    def refresh_snapshots(self):
+        """
+        Update the lineup snapshots without recalculating the lineup - for changes that affect what singers see on
+        their dashboard (skipping a song, changing partners), but not the positions
+        """
+        with advisory_lock(LINEUP_LOCK):
+            current_positions, songs = self._lineup_songs()
+            self._write_snapshots(songs, {pk: position for pk, position in current_positions.items()
+                                          if position is not None})
+
+    def request_recalculation(self):
+        """
+        Mark the lineup as needing a recalculation, without waiting for it.
+        The first change within the debounce window schedules a single recalculation on the celery worker, and any
+        change after it is already committed by the time that recalculation reads the lineup - so a burst of signups
+        is folded into one recalculation instead of queueing behind each other. Readers always see a complete lineup,
+        since each recalculation writes all positions in one statement.
+        """
+        delay = settings.LINEUP_RECALC_DEBOUNCE
+        if not delay:
+            self.calculate_positions()
+            return
+
+        def schedule():
+            # Marked only once committed - a rolled back change would leave the mark with no recalculation coming
+            if get_redis().set(RECALC_PENDING_KEY, 1, nx=True, ex=RECALC_PENDING_TIMEOUT):
+                from song_signup.tasks import recalculate_positions
+                recalculate_positions.apply_async(countdown=delay)
+
+        transaction.on_commit(schedule)
+
+    def run_pending_recalculation(self):
+        # Clear the mark first, so changes made while recalculating schedule the next recalculation
+        get_redis().delete(RECALC_PENDING_KEY)
+        self.calculate_positions()
 
     def singer_disneyland_ordering(self):
         """
@@ -141,14 +309,9 @@ class DisneylandOrdering(UserManager):
         to the order that they were in before. Basically, we're just taking the existing list and pulling the new
         singers ahead, without changing the internal ordering.
         """
-        if flag_enabled('CAN_SIGNUP'):
-            return sorted(self.active_singers(), key=lambda singer: singer.last_performance_time
-                                                                    or singer.first_request_time)
-        else:
-            all_singers = self.active_singers()
-            new_singers, old_singers = [], []
-            for singer in all_singers:
-                new_singers.append(singer) if singer.last_performance_time is None else old_singers.append(singer)
-
-            return sorted(new_singers, key=lambda singer: singer.first_request_time) + sorted(old_singers, key=lambda
-                singer: singer.last_performance_time)
+        singers = {singer.pk: singer for singer in self.active_singers_queryset()}
+        records = [SingerRecord(pk=singer.pk, first_request_at=singer.first_request_at,
+                                last_performance_at=singer.last_performance_at, is_audience=singer.is_audience)
+                   for singer in singers.values()]
+
+        return [singers[record.pk] for record in order_singers(records, flag_enabled('CAN_SIGNUP'))]
@@ -0,0 +1,16 @@
+from constance import config
+
+
+class ConfigSnapshotMiddleware:
+    """Read the constance config once per request (see twist.constance_backend)"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        backend = config._backend
+        backend.start_snapshot()
+        try:
+            return self.get_response(request)
+        finally:
+            backend.end_snapshot()
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.2 on 2026-10-18 02:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('song_signup', '0064_songrequest_is_peoples_choice'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LineupSnapshot',
+            fields=[
+                ('singer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='lineup_snapshot', serialize=False, to='song_signup.singer')),
+                ('position', models.IntegerField(null=True)),
+                ('wait_amount', models.IntegerField(null=True)),
+                ('song', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='song_signup.songrequest')),
+            ],
+        ),
+    ]
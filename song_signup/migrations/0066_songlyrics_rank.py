@@ -0,0 +1,48 @@
+# Generated by Django 3.1.2 on 2026-10-18 03:05
+
+from django.db import migrations, models
+
+
+def rank_lyrics(apps, schema_editor):
+    """Same as song_signup.models.lyrics_rank, as of this migration"""
+    SongLyrics = apps.get_model('song_signup', 'SongLyrics')
+    for lyrics in SongLyrics.objects.select_related('song_request', 'group_song_request'):
+        song = lyrics.song_request or lyrics.group_song_request
+        if not song:
+            continue
+
+        song_name = song.song_name.lower()
+        title = lyrics.song_name.lower()
+        if song_name == title:
+            lyrics.rank = 1
+        elif song_name in title:
+            lyrics.rank = 2
+        elif title in song_name:
+            lyrics.rank = 3
+        else:
+            continue
+        lyrics.save(update_fields=['rank'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('song_signup', '0065_lineupsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='songlyrics',
+            name='rank',
+            field=models.IntegerField(default=4),
+        ),
+        migrations.RunPython(rank_lyrics, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='songlyrics',
+            index=models.Index(fields=['song_request', '-default', 'rank', 'id'], name='song_lyrics_best_first'),
+        ),
+        migrations.AddIndex(
+            model_name='songlyrics',
+            index=models.Index(fields=['group_song_request', '-default', 'rank', 'id'], name='group_song_lyrics_best_first'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.1.2 on 2026-10-18 03:15
+
+from django.db import migrations, models
+
+
+def _normalize_string(s):
+    return ' '.join(s.lower().split()) if s else ''
+
+
+def fill_library(apps, schema_editor):
+    SongLyrics = apps.get_model('song_signup', 'SongLyrics')
+    LibraryLyrics = apps.get_model('song_signup', 'LibraryLyrics')
+
+    library = []
+    for lyrics in SongLyrics.objects.select_related('song_request', 'group_song_request'):
+        song = lyrics.song_request or lyrics.group_song_request
+        if song:
+            library.append(LibraryLyrics(song_name=_normalize_string(song.song_name),
+                                         musical=_normalize_string(song.musical), lyrics_song_name=lyrics.song_name,
+                                         artist_name=lyrics.artist_name, lyrics=lyrics.lyrics, url=lyrics.url,
+                                         default=lyrics.default))
+    LibraryLyrics.objects.bulk_create(library)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('song_signup', '0066_songlyrics_rank'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LibraryLyrics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('song_name', models.TextField()),
+                ('musical', models.TextField()),
+                ('lyrics_song_name', models.TextField()),
+                ('artist_name', models.TextField()),
+                ('lyrics', models.TextField()),
+                ('url', models.URLField(blank=True, null=True)),
+                ('default', models.BooleanField(default=False)),
+            ],
+            options={
+                'verbose_name_plural': 'Library lyrics',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='librarylyrics',
+            index=models.Index(fields=['song_name', 'musical'], name='library_lyrics_song'),
+        ),
+        migrations.RunPython(fill_library, migrations.RunPython.noop),
+    ]
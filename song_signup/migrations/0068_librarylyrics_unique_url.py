@@ -0,0 +1,32 @@
+# Generated by Django 3.1.2 on 2026-10-18 09:40
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def remove_duplicates(apps, schema_editor):
+    """Keep one entry per page of each song - the default, if one of them is"""
+    LibraryLyrics = apps.get_model('song_signup', 'LibraryLyrics')
+    LibraryLyrics.objects.filter(url='').update(url=None)  # As the library looks up lyrics without a page
+
+    duplicated = (LibraryLyrics.objects.filter(url__isnull=False).values('song_name', 'musical', 'url')
+                  .annotate(count=Count('id')).filter(count__gt=1))
+    for page in duplicated:
+        entries = LibraryLyrics.objects.filter(song_name=page['song_name'], musical=page['musical'], url=page['url'])
+        kept = entries.order_by('-default', 'id').first()
+        entries.exclude(id=kept.id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('song_signup', '0067_librarylyrics'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='librarylyrics',
+            unique_together={('song_name', 'musical', 'url')},
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 3.1.2 on 2026-10-18 09:55
+
+from django.db import migrations
+
+
+def fill_snapshots(apps, schema_editor):
+    """
+    The snapshots of the current lineup (see LineupSnapshot) - otherwise the dashboards of a running evening show
+    nothing until its next recalculation.
+    Same as song_signup.ordering.next_songs over the songs that weren't performed, as of this migration.
+    """
+    SongRequest = apps.get_model('song_signup', 'SongRequest')
+    LineupSnapshot = apps.get_model('song_signup', 'LineupSnapshot')
+
+    songs = {}
+    for pk, singer_pk, priority, skipped, placeholder, position, partner_pk in SongRequest.objects.filter(
+            performance_time__isnull=True).order_by().values_list(
+            'pk', 'singer_id', 'priority', 'skipped', 'placeholder', 'position', 'partners'):
+        song = songs.setdefault(pk, {'pk': pk, 'singer_pks': [singer_pk], 'priority': priority, 'skipped': skipped,
+                                     'placeholder': placeholder, 'position': position})
+        if partner_pk is not None:
+            song['singer_pks'].append(partner_pk)
+
+    current_position = min((song['position'] for song in songs.values() if song['position'] is not None
+                            and not song['skipped'] and not song['placeholder']), default=None)
+
+    def sort_key(song):
+        return song['position'] is None, song['position'] or 0, song['priority'], song['pk']
+
+    snapshots = {}
+    for song in sorted(songs.values(), key=sort_key):
+        position = song['position']
+        wait_amount = position - current_position if position and current_position is not None else None
+        for singer_pk in song['singer_pks']:
+            snapshots.setdefault(singer_pk, LineupSnapshot(singer_id=singer_pk, song_id=song['pk'], position=position,
+                                                           wait_amount=wait_amount))
+
+    LineupSnapshot.objects.all().delete()
+    LineupSnapshot.objects.bulk_create(snapshots.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('song_signup', '0068_librarylyrics_unique_url'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_snapshots, migrations.RunPython.noop),
+    ]
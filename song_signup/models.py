@@ -6,6 +6,7 @@ from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.contrib.postgres.fields import CITextField
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.db.models import (
     CASCADE,
     PROTECT,
@@ -20,20 +21,26 @@ from django.db.models import (
     CharField,
     OneToOneField,
     ImageField,
+    Index,
     JSONField,
 )
-from django.db.models.signals import m2m_changed
-from twist.utils import format_commas
+from django.db.models.signals import m2m_changed, post_delete, post_migrate, post_save
+from twist.flag_sources import bump_flags_version
+from twist.utils import format_commas, get_redis
 from django.utils import timezone
 from titlecase import titlecase
 from constance import config
+from constance.signals import config_updated
+from flags.models import FlagState
 
 from song_signup.managers import (
     DisneylandOrdering,
     SongRequestManager,
     SongSuggestionManager,
+    LibraryLyricsManager,
     GroupSongRequestManager,
 )
+from song_signup.stage import bump_lyrics_version, bump_stage_version
 
 SING_SKU = 'SING'
 ATTN_SKU = 'ATTN'
@@ -96,10 +103,33 @@ class Singer(AbstractUser):
     raffle_winner = BooleanField(default=False)
     active_raffle_winner = BooleanField(default=False) # Show raffle winner animation
 
+    cached_session_auth_hash = None  # Set on users loaded from the cache (see CachedModelBackend)
+
+    # Shown on the stage (see singer_saved)
+    STAGE_FIELDS = ('username', 'first_name', 'last_name', 'is_audience', 'raffle_participant', 'raffle_winner',
+                    'active_raffle_winner')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._original_stage_fields = self.stage_fields()
+
+    def stage_fields(self):
+        # Read from __dict__, so that deferred fields aren't loaded
+        fields = {field: self.__dict__.get(field) for field in self.STAGE_FIELDS}
+        if fields['raffle_participant']:
+            fields['is_active'] = self.__dict__.get('is_active')  # Inactive singers aren't in the raffle
+        return fields
+
     @property
     def is_singer(self):
         return not self.is_audience or self.raffle_winner
 
+    def get_session_auth_hash(self):
+        # Rebuilt from its cached record (see CachedModelBackend), the user has the hash but not the password
+        if self.cached_session_auth_hash and 'password' in self.get_deferred_fields():
+            return self.cached_session_auth_hash
+        return super().get_session_auth_hash()
+
     def save(self, *args, **kwargs):
         # Only validate on creation:
         if not self.pk and not self.is_superuser:
@@ -219,6 +249,22 @@ class CurrentGroupSong(Model):
             instance.delete()
 
 
+def get_current_song():
+    """
+    Return current_song, is_group_song
+    """
+    curr_group_song = CurrentGroupSong.objects.all().first()
+    if curr_group_song and curr_group_song.is_active:
+        return curr_group_song.group_song, True
+    else:
+        return SongRequest.objects.get_spotlight() or SongRequest.objects.current_song(), False
+
+
+def current_song_key(song, is_group_song):
+    """Identifies the current song - a solo and a group song may share an id"""
+    return song and f"{'group' if is_group_song else 'song'}:{song.pk}"
+
+
 class SongSuggestion(Model):
     song_name = CITextField(max_length=50)
     musical = CITextField(max_length=50)
@@ -400,7 +446,50 @@ def validate_partners_changed(sender, instance, action, **kwargs):
                              f"Show this to Alon - it seems like a bug.. :(")
 
 
+class LineupSnapshot(Model):
+    """
+    A singer's next song (as the primary singer or as a partner) and how long until it's their turn, as of the last
+    lineup recalculation. Maintained by the ordering manager, so the dashboard doesn't have to work it out on every
+    poll.
+    """
+    singer = OneToOneField(settings.AUTH_USER_MODEL, on_delete=CASCADE, primary_key=True,
+                           related_name='lineup_snapshot')
+    song = ForeignKey(SongRequest, on_delete=CASCADE, related_name='+')
+    position = IntegerField(null=True)
+    wait_amount = IntegerField(null=True)  # None if the song isn't scheduled yet
+
+    @property
+    def basic_data(self):
+        return {'id': self.song_id, 'name': self.song.song_name, 'singer': str(self.song.singer),
+                'wait_amount': self.wait_amount}
+
+
+def lyrics_rank(song_name, lyrics_title):
+    """
+    Our best guess of how well lyrics match a song, by their titles (lower is better).
+    Tried a few algorithms here but this relatively simple one worked best.
+    """
+    song_name = song_name.lower()
+    lyrics_title = lyrics_title.lower()
+
+    if song_name == lyrics_title:
+        return SongLyrics.EXACT_MATCH
+    if song_name in lyrics_title:
+        return SongLyrics.LEFT_MATCH
+    if lyrics_title in song_name:
+        return SongLyrics.RIGHT_MATCH
+    return SongLyrics.NO_MATCH
+
+
 class SongLyrics(Model):
+    EXACT_MATCH = 1
+    LEFT_MATCH = 2  # The song name is included in the title of the lyrics
+    RIGHT_MATCH = 3  # The title of the lyrics is included in the song name
+    NO_MATCH = 4
+
+    # The chosen lyrics first, then by rank, and by ID for consistency
+    BEST_FIRST = ('-default', 'rank', 'id')
+
     song_name = TextField()
     artist_name = TextField()
     lyrics = TextField()
@@ -408,23 +497,61 @@ class SongLyrics(Model):
     song_request = ForeignKey(SongRequest, on_delete=CASCADE, related_name='lyrics', null=True, blank=True)
     group_song_request = ForeignKey(GroupSongRequest, on_delete=CASCADE, related_name='lyrics', null=True, blank=True)
     default = BooleanField(default=False)
+    rank = IntegerField(default=NO_MATCH)  # See lyrics_rank
 
     class Meta:
         verbose_name_plural = "Song lyrics"
+        indexes = [
+            # The best lyrics of a song are a single index lookup (in BEST_FIRST order)
+            Index(fields=['song_request', '-default', 'rank', 'id'], name='song_lyrics_best_first'),
+            Index(fields=['group_song_request', '-default', 'rank', 'id'], name='group_song_lyrics_best_first'),
+        ]
 
     def save(self, *args, **kwargs):
         # Limit consecutive newlines to three
         self.lyrics = re.sub(r'\n{4,}', '\n' * 3, self.lyrics)
 
+        song = self.song_request or self.group_song_request
+        if song:
+            self.rank = lyrics_rank(song.song_name, self.song_name)
+
         # Only one can be default
         if self.default:
             if self.song_request:
                 self.song_request.lyrics.update(default=False)
             if self.group_song_request:
                 self.group_song_request.lyrics.update(default=False)
+            if song:
+                LibraryLyrics.objects.set_default(song, self)
 
         super().save(*args, **kwargs)
 
+
+class LibraryLyrics(Model):
+    """
+    Every evening's lyrics search results, kept across evenings (unlike SongLyrics, which go with their song) - so a
+    song that was sung before gets its lyrics, and the lyrics that were chosen for it, without searching again.
+    """
+    song_name = TextField()  # Normalized, see _normalize_string
+    musical = TextField()  # Normalized
+    lyrics_song_name = TextField()  # The SongLyrics.song_name - the title of the lyrics
+    artist_name = TextField()
+    lyrics = TextField()
+    url = URLField(null=True, blank=True)
+    default = BooleanField(default=False)
+
+    objects = LibraryLyricsManager()
+
+    class Meta:
+        verbose_name_plural = "Library lyrics"
+        indexes = [Index(fields=['song_name', 'musical'], name='library_lyrics_song')]
+        unique_together = ('song_name', 'musical', 'url')  # A page is kept once per song (lyrics without one aren't)
+
+    def to_song_lyrics(self, song, is_group_song):
+        return SongLyrics(song_name=self.lyrics_song_name, artist_name=self.artist_name, lyrics=self.lyrics,
+                          url=self.url, default=self.default, song_request=None if is_group_song else song,
+                          group_song_request=song if is_group_song else None)
+
 TRIVIA_CHOICES = ((1, 'A'), (2, 'B'), (3, 'C'), (4, 'D'))
 
 class TriviaQuestion(Model):
@@ -478,3 +605,90 @@ class TriviaResponse(Model):
     @property
     def is_correct(self):
         return self.question.answer is self.choice
+
+
+# Models that make up the state polled by the clients (see song_signup.stage). Singers and lyrics are only part of it
+# in some of their fields or rows (see singer_saved, lyrics_changed), and trivia responses only through the trivia
+# winner, which reveal_trivia_winner publishes.
+STAGE_MODELS = (SongRequest, GroupSongRequest, CurrentGroupSong, SongSuggestion, TriviaQuestion, FlagState)
+
+
+def stage_changed(sender, **kwargs):
+    bump_stage_version()
+
+
+# Connected per model - a receiver for all senders would also stop Django from fast-deleting lineup snapshots
+for stage_model in STAGE_MODELS:
+    post_save.connect(stage_changed, sender=stage_model)
+    post_delete.connect(stage_changed, sender=stage_model)
+
+
+@receiver(post_save, sender=Singer)
+def singer_saved(sender, instance, **kwargs):
+    # Logins and logouts (last_login, is_active) don't change the stage - names and the raffle do
+    stage_fields = instance.stage_fields()
+    if stage_fields != instance._original_stage_fields:
+        bump_stage_version()
+    instance._original_stage_fields = stage_fields
+
+
+@receiver(post_delete, sender=Singer)
+def singer_deleted(sender, **kwargs):
+    bump_stage_version()
+
+
+@receiver([post_save, post_delete], sender=SongLyrics)
+def lyrics_changed(sender, instance, **kwargs):
+    # Only the lyrics of the current song are shown - new songs' lyrics arrive all through the evening
+    song, is_group_song = get_current_song()
+    lyrics_song_id = instance.group_song_request_id if is_group_song else instance.song_request_id
+    if song is not None and lyrics_song_id == song.pk:
+        bump_lyrics_version()
+
+
+@receiver(post_save, sender=TriviaResponse)
+def trivia_response_saved(sender, instance, created, **kwargs):
+    if created and instance.is_correct:
+        transaction.on_commit(lambda: _schedule_winner_reveal(instance.question_id))
+
+
+WINNER_SCHEDULED_TIMEOUT = 60 * 60 * 24  # Seconds - only needs to outlive the question
+
+
+def _schedule_winner_reveal(question_id):
+    # Only the first correct response wins - the ones after it don't need a reveal of their own
+    if get_redis().set(f'trivia:{question_id}:winner-scheduled', 1, nx=True, ex=WINNER_SCHEDULED_TIMEOUT):
+        from song_signup.tasks import reveal_trivia_winner
+        reveal_trivia_winner.apply_async(countdown=TriviaQuestion.WINNER_DISPLAY_DELAY)
+
+
+@receiver(m2m_changed, sender=SongRequest.partners.through)
+def stage_partners_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_stage_version()
+
+
+@receiver([post_save, post_delete], sender=Singer)
+def singer_changed(sender, instance, **kwargs):
+    from twist.auth_backends import forget_cached_user  # Needs the user model to be loaded
+    forget_cached_user(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=FlagState)
+def flags_changed(sender, **kwargs):
+    bump_flags_version()
+
+
+@receiver(post_migrate)
+def tables_flushed(sender, **kwargs):
+    # Also sent by flush, which empties the tables without sending signals
+    bump_flags_version()
+    bump_lyrics_version()  # And with it the stage version - the snapshot of the emptied tables is outdated
+
+
+@receiver(config_updated)
+def stage_config_changed(sender, key, **kwargs):
+    if key == 'DRINKING_WORDS':
+        bump_lyrics_version()  # Highlighted in the lyrics
+    else:
+        bump_stage_version()
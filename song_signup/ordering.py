@@ -0,0 +1,104 @@
+"""
+The rules of the Disneyland lineup, over plain records instead of models.
+Nothing here touches the DB, so the algorithm can be run (and timed) on its own - the ordering manager loads the
+records, and writes back the positions calculated here.
+"""
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+@dataclass
+class SingerRecord:
+    pk: int
+    first_request_at: datetime  # When the singer requested their first song
+    last_performance_at: Optional[datetime] = None  # None if the singer hasn't sung yet
+    is_audience: bool = False  # Audience members (including raffle winners) are never scheduled in the lineup
+
+
+@dataclass
+class SongRecord:
+    """A song that wasn't performed yet"""
+    pk: int
+    singer_pk: int
+    priority: int
+    standby: bool = False
+    skipped: bool = False
+    placeholder: bool = False
+    deferred: bool = False  # Requested for a later time, so it can't be scheduled yet
+    partner_pks: List[int] = field(default_factory=list)
+
+
+NextSong = Tuple[int, Optional[int], Optional[int]]  # Song pk, position, wait amount
+
+
+def order_singers(singers: Iterable[SingerRecord], can_signup: bool) -> List[SingerRecord]:
+    """
+    Returns the order of the singers in the lineup.
+    While the signup is open, it's first come, first served, and once a singer has sung, they move to the end of the
+    line. Once it's closed, singers who haven't sung yet get precedence, sorted by their first request, and only
+    then singers who have sung, in the order that they were in before.
+    """
+    singers = [singer for singer in singers if not singer.is_audience]
+
+    if can_signup:
+        return sorted(singers, key=lambda singer: (singer.last_performance_at or singer.first_request_at, singer.pk))
+    else:
+        return sorted(singers, key=lambda singer: (singer.last_performance_at is not None,
+                                                   singer.last_performance_at or singer.first_request_at,
+                                                   singer.first_request_at,
+                                                   singer.pk))
+
+
+def assign_positions(singer_pks: Iterable[int], songs: Iterable[SongRecord]) -> Dict[int, int]:
+    """
+    Schedule the next song of each singer (lowest priority that isn't on standby or deferred), in the order of the
+    singers.
+    Returns a dict of song pk -> position. Singers without such a song don't take a slot.
+    """
+    singer_next_songs = {}
+    for song in songs:
+        if song.standby or song.deferred:
+            continue
+        current = singer_next_songs.get(song.singer_pk)
+        if current is None or song.priority < current.priority:
+            singer_next_songs[song.singer_pk] = song
+
+    positions = {}
+    for singer_pk in singer_pks:
+        song = singer_next_songs.get(singer_pk)
+        if song:
+            positions[song.pk] = len(positions) + 1
+
+    return positions
+
+
+def calculate_lineup(singers: Iterable[SingerRecord], songs: Iterable[SongRecord], can_signup: bool) -> Dict[int, int]:
+    """Returns the position of each scheduled song (song pk -> position)"""
+    return assign_positions([singer.pk for singer in order_singers(singers, can_signup)], songs)
+
+
+def next_songs(songs: Iterable[SongRecord], positions: Dict[int, int]) -> Dict[int, NextSong]:
+    """
+    The next song of every singer (as the primary singer or as a partner), given the positions in the lineup.
+    Scheduled songs come first, by position. A singer with no scheduled song gets their first unscheduled one.
+    Returns a dict of singer pk -> (song pk, position, wait amount). The wait amount is the number of songs until the
+    singer's song, counted from the current song (the first one in the lineup that isn't skipped), and None if the
+    song isn't scheduled yet.
+    """
+    songs = list(songs)
+    current_position = min((positions[song.pk] for song in songs
+                            if song.pk in positions and not song.skipped and not song.placeholder), default=None)
+
+    def sort_key(song):
+        position = positions.get(song.pk)
+        return position is None, position or 0, song.priority, song.pk
+
+    result = {}
+    for song in sorted(songs, key=sort_key):
+        position = positions.get(song.pk)
+        wait_amount = position - current_position if position and current_position is not None else None
+        for singer_pk in [song.singer_pk, *song.partner_pks]:
+            result.setdefault(singer_pk, (song.pk, position, wait_amount))
+
+    return result
@@ -0,0 +1,55 @@
+"""
+How often the clients should poll, told to them with every polled response (X-Poll-Interval, in ms).
+Audience phones back off when the server is slow or when the admin turns on rush mode, so a slow server isn't made
+slower by clients polling at full rate. Superusers' screens (live lyrics, admin) always keep the full rate.
+"""
+import time
+from functools import wraps
+
+from constance import config
+
+POLL_INTERVAL = 1000  # ms, while the server keeps up
+RUSH_POLL_INTERVAL = 3000  # ms, for the audience in rush mode
+MAX_POLL_INTERVAL = 10000  # ms
+LATENCY_FACTOR = 20  # The audience polls no more often than once per this many request latencies
+LATENCY_SMOOTHING = 0.1  # Weight of each new measurement in the moving average
+
+_latency = 0.0  # Moving average of the latency of polled requests in this process, in ms
+
+
+def request_latency(request, handled_at):
+    """
+    Time since the request reached the proxy, which adds X-Request-Start (t=<ms since epoch>) - so the time spent
+    waiting for a worker counts too. Without the header, only the time spent handling the request is known.
+    """
+    request_start = request.META.get('HTTP_X_REQUEST_START', '')
+    if request_start.startswith('t='):
+        try:
+            return max(0.0, time.time() * 1000 - float(request_start[2:]))
+        except ValueError:
+            pass
+    return (time.monotonic() - handled_at) * 1000
+
+
+def poll_interval(user):
+    if user.is_superuser:
+        return POLL_INTERVAL
+
+    interval = max(POLL_INTERVAL, _latency * LATENCY_FACTOR)
+    if config.RUSH_MODE:
+        interval = max(interval, RUSH_POLL_INTERVAL)
+    return int(min(interval, MAX_POLL_INTERVAL))
+
+
+def polled(view):
+    """Measure the latency of a polled view, and tell the client when to poll next"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        global _latency
+        handled_at = time.monotonic()
+        response = view(request, *args, **kwargs)
+        _latency += (request_latency(request, handled_at) - _latency) * LATENCY_SMOOTHING
+        response['X-Poll-Interval'] = poll_interval(request.user)
+        return response
+
+    return wrapper
@@ -0,0 +1,122 @@
+"""
+Version of the stage state (lineup, spotlight, flags, trivia, raffle, lyrics) that the clients poll.
+Every change to any of them bumps the version, so a client can tell whether anything changed since its last poll.
+The lyrics of the current song have a version of their own, so that the (much larger) lyrics are only fetched again
+when they change - and not on every change of the stage.
+"""
+import json
+import time
+import uuid
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+
+from twist.utils import get_redis
+
+STAGE_VERSION_KEY = 'stage:version'
+STAGE_SNAPSHOT_KEY = 'stage:snapshot'
+STAGE_CHANNEL = 'stage:events'  # Every new version is published here, for the push channel (see stage_events)
+LYRICS_VERSION_KEY = 'stage:lyrics-version'
+SNAPSHOT_REBUILD_LOCK = 'stage:snapshot:rebuild'
+SNAPSHOT_REBUILD_TIMEOUT = 2000  # ms - the longest a poll waits for another one's rebuild, before building it itself
+SNAPSHOT_WAIT_INTERVAL = 0.02  # Seconds between checks for the rebuilt snapshot
+
+
+def stage_version():
+    return int(get_redis().get(STAGE_VERSION_KEY) or 0)
+
+
+def lyrics_version():
+    return int(get_redis().get(LYRICS_VERSION_KEY) or 0)
+
+
+def _current_snapshot(redis):
+    """The snapshot, if it was built for the current version - and the current version"""
+    version, snapshot = redis.mget(STAGE_VERSION_KEY, STAGE_SNAPSHOT_KEY)
+    version = int(version or 0)
+    if snapshot is not None:
+        snapshot = json.loads(snapshot)
+        if snapshot['version'] == version:
+            return snapshot, version
+    return None, version
+
+
+def stage_snapshot(build):
+    """
+    The part of the state that's the same for every client, materialized in Redis along with the version it was built
+    for, so that a poll costs a single round trip to Redis instead of the queries of `build`.
+    The first poll after the version changes rebuilds it - just one: the polls that come with it (every client is told
+    about the new version at once) wait for that rebuild, rather than all building the same snapshot.
+    """
+    redis = get_redis()
+    snapshot, version = _current_snapshot(redis)
+    if snapshot is not None:
+        return snapshot
+
+    # Inside a transaction, we may be seeing changes that will never be committed - don't share them
+    if transaction.get_connection().in_atomic_block:
+        return {'version': version, **json.loads(json.dumps(build(), cls=DjangoJSONEncoder))}
+
+    token = uuid.uuid4().hex
+    if not redis.set(SNAPSHOT_REBUILD_LOCK, token, nx=True, px=SNAPSHOT_REBUILD_TIMEOUT):
+        deadline = time.monotonic() + SNAPSHOT_REBUILD_TIMEOUT / 1000
+        while time.monotonic() < deadline:
+            time.sleep(SNAPSHOT_WAIT_INTERVAL)
+            snapshot, version = _current_snapshot(redis)
+            if snapshot is not None:
+                return snapshot
+        # The rebuild is taking too long (or its process died) - build it ourselves
+
+    try:
+        snapshot = json.dumps({'version': version, **build()}, cls=DjangoJSONEncoder)
+        redis.set(STAGE_SNAPSHOT_KEY, snapshot)
+    finally:
+        if redis.get(SNAPSHOT_REBUILD_LOCK) == token.encode():
+            redis.delete(SNAPSHOT_REBUILD_LOCK)
+    return json.loads(snapshot)
+
+
+def bump_stage_version():
+    """
+    Bump the version once the current transaction commits - bumping before would let a client read the new version
+    along with the old state, and miss the change.
+    """
+    transaction.on_commit(_publish_stage_version)
+
+
+def _publish_stage_version():
+    redis = get_redis()
+    redis.publish(STAGE_CHANNEL, redis.incr(STAGE_VERSION_KEY))
+
+
+def bump_lyrics_version():
+    """The lyrics of the current song changed - the stage too, so the clients find out"""
+    transaction.on_commit(_publish_lyrics_version)
+
+
+def _publish_lyrics_version():
+    get_redis().incr(LYRICS_VERSION_KEY)
+    _publish_stage_version()
+
+
+def stage_etag(per_user=False):
+    """
+    Tag the responses of a polled view with the stage version, and answer a poll with an unchanged version with a 304,
+    before the view (and its queries and serializers) runs.
+    Views that depend on the user set `per_user`, so a different user on the same browser doesn't get a stale body.
+    """
+    def etag(request, *args, **kwargs):
+        version = stage_version()
+        return f'{version}-{request.user.pk}' if per_user else str(version)
+
+    return polled_etag(etag)
+
+
+def polled_etag(etag_func):
+    def decorator(view):
+        # no-cache - the browser may keep the body, but has to revalidate it on every poll
+        return cache_control(no_cache=True)(condition(etag_func=etag_func)(view))
+
+    return decorator
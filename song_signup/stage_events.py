@@ -0,0 +1,109 @@
+"""
+Server-Sent Events push channel for the stage state.
+Clients subscribe once to /stage_events and get an event whenever the stage version changes (see song_signup.stage),
+instead of polling /stage_state every second. The event only carries the new version - the client then fetches
+/stage_state once.
+Each process subscribes to the Redis channel once and fans the versions out to its own clients.
+"""
+import asyncio
+from logging import getLogger
+
+from django.conf import settings
+from redis import asyncio as aioredis
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from .stage import STAGE_CHANNEL, STAGE_VERSION_KEY
+
+logger = getLogger(__name__)
+
+KEEPALIVE_INTERVAL = 15  # Seconds between comments on an idle stream, so proxies don't drop the connection
+RECONNECT_DELAY = 1  # Seconds before resubscribing after losing Redis, doubled on each failure in a row
+MAX_RECONNECT_DELAY = 30
+RETRY_MS = 3000  # How long the browser waits before reconnecting a dropped stream
+
+HEADERS = [
+    (b'content-type', b'text/event-stream'),
+    (b'cache-control', b'no-cache'),
+    (b'x-accel-buffering', b'no'),
+]
+
+
+class StageEvents:
+    """ASGI app streaming the stage version to every connected client"""
+
+    def __init__(self):
+        self.version = None
+        self.changed = None  # Set (and replaced) whenever the version changes
+        self.listener = None
+
+    async def __call__(self, scope, receive, send):
+        if self.listener is None:
+            self.changed = asyncio.Event()
+            self.listener = asyncio.ensure_future(self.listen())
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': HEADERS})
+        await self.send_event(send, f'retry: {RETRY_MS}\n\n')
+
+        disconnected = asyncio.ensure_future(self.wait_for_disconnect(receive))
+        sent_version = None
+        try:
+            while not disconnected.done():
+                # Taken before looking at the version, so that a change while we send is not missed until the
+                # keepalive - it sets this very event
+                change = self.changed
+                if self.version is not None and self.version != sent_version:
+                    sent_version = self.version
+                    await self.send_event(send, f'event: stage\ndata: {sent_version}\n\n')
+
+                changed = asyncio.ensure_future(change.wait())
+                done, _ = await asyncio.wait([changed, disconnected], timeout=KEEPALIVE_INTERVAL,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                changed.cancel()
+                if not done:
+                    await self.send_event(send, ': keepalive\n\n')
+        finally:
+            disconnected.cancel()
+
+    @staticmethod
+    async def send_event(send, event):
+        await send({'type': 'http.response.body', 'body': event.encode(), 'more_body': True})
+
+    @staticmethod
+    async def wait_for_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    def set_version(self, version):
+        if version == self.version:
+            return
+        self.version = version
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def listen(self):
+        """Follow the Redis channel for as long as the process lives, resubscribing if Redis goes away"""
+        redis = aioredis.Redis(host=settings.REDIS_HOST, db=settings.REDIS_DB)
+        delay = RECONNECT_DELAY
+        while True:
+            pubsub = redis.pubsub()
+            try:
+                await pubsub.subscribe(STAGE_CHANNEL)
+                # Changes published before we subscribed are only reflected in the stored version
+                self.set_version(int(await redis.get(STAGE_VERSION_KEY) or 0))
+                delay = RECONNECT_DELAY
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.set_version(int(message['data']))
+            except RedisConnectionError:
+                logger.warning(f"Lost the connection to Redis, resubscribing in {delay}s")
+            except Exception:
+                # Whatever went wrong, the listener must not die - every client of this process would stop getting
+                # events
+                logger.exception(f"Stage events listener failed, resubscribing in {delay}s")
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass  # The connection is already gone
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
@@ -1,3 +1,5 @@
+import { onStageState, refreshStageState } from "./stage-state.js";
+
 const newSongForm = document.getElementById("new-song-form");
 const dialogModal = document.getElementById('duplicate-song-dialog');
 const dialogReset = dialogModal.querySelector('.reset');
@@ -66,24 +68,21 @@ newSongForm.addEventListener('submit', addSong);
 const signupsDisabledBanner = document.getElementById("signups-disabled-text");
 
 const formFields = newSongForm.querySelectorAll("input, select");
-function checkDisableSignup() {
-    fetch("/signup_disabled")
-        .then((response) => response.json())
-        .then((data) => {
-            if (data.result) {
-                signupsDisabledBanner.classList.add("signups-disabled")
-                formFields.forEach((field) => {
-                    field.disabled = true;
-                    field.classList.add("signups-disabled")
-                });
-            } else {
-                signupsDisabledBanner.classList.remove("signups-disabled")
-                formFields.forEach((field) => {
-                    field.disabled = false;
-                    field.classList.remove("signups-disabled")
-                });
-            }
+function disableSignup(state) {
+    if (!state.can_signup) {
+        signupsDisabledBanner.classList.add("signups-disabled")
+        formFields.forEach((field) => {
+            field.disabled = true;
+            field.classList.add("signups-disabled")
         });
+    } else {
+        signupsDisabledBanner.classList.remove("signups-disabled")
+        formFields.forEach((field) => {
+            field.disabled = false;
+            field.classList.remove("signups-disabled")
+        });
+    }
 }
 
-setInterval(checkDisableSignup, 500);
\ No newline at end of file
+onStageState(disableSignup);
+refreshStageState();
@@ -1,4 +1,5 @@
 import { getCookie } from "./utils.js";
+import { onStageState } from "./stage-state.js";
 
 const questionText = document.querySelector(".question-text");
 const questionImage = document.getElementById("question-image-base");
@@ -23,14 +24,13 @@ answers.forEach(answer => {
 const csrftoken = getCookie('csrftoken');
 
 if (isLoggedIn) {
-    setInterval(getQuestion, 500);
+    onStageState(showQuestion);
 }
 
-async function getQuestion() {
-    const questionRes = await fetch("/get_active_question");
-    const question = await questionRes.json();
+async function showQuestion(state) {
+    const question = state.active_question;
 
-    if (questionRes.status === 200 && Object.keys(question).length > 0 && isLoggedIn && !isSuperuser) {
+    if (Object.keys(question).length > 0 && isLoggedIn && !isSuperuser) {
         const winner = question.winner;
         const image = question.image;
 
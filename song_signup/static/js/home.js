@@ -1,4 +1,5 @@
 import { loadWait } from "./utils.js";
+import { onStageState, refreshStageState } from "./stage-state.js";
 
 // Fetch and populate data in the home page
 const currentSinger = document.querySelector(".headliner").firstElementChild;
@@ -11,18 +12,13 @@ const dashboardElem = document.getElementById("home-dashboard");
 const noSongElem = document.getElementById("no-song");
 const spotlightElem = document.getElementById("now-singing-wrapper");
 
-setInterval(populateSpotlight, 1000);
-window.addEventListener("DOMContentLoaded", loadWait(populateSpotlight));
+onStageState(populateSpotlight);
+window.addEventListener("DOMContentLoaded", loadWait(refreshStageState));
 
 
-async function populateSpotlight() {
-
-    const startedRes = await fetch("/evening_started");
-    const eveningStarted = (await startedRes.json()).started;
-
-    if (!eveningStarted) {
-        const nextSingerRes = await fetch("/next_singer");
-        const nextSingerUsername = (await nextSingerRes.json()).next_singer
+function populateSpotlight(state) {
+    if (!state.started) {
+        const nextSingerUsername = state.next_singer;
         spotlightElem.classList.add('curtain');
         spotlightElem.firstElementChild.classList.add('hidden')
         if (djangoUsername === nextSingerUsername) {
@@ -36,8 +32,7 @@ async function populateSpotlight() {
     }
 
 
-    const spotlightRes = await fetch("/spotlight_data");
-    const spotlightData = await spotlightRes.json()
+    const spotlightData = state.spotlight;
     const currentSongData = spotlightData.current_song;
     const nextSongData = spotlightData.next_song;
 
@@ -58,45 +53,45 @@ async function populateSpotlight() {
     }
 }
 
-function populateDashboard() {
-    return fetch("/dashboard_data")
-        .then((response) => response.json())
-        .then((data) => {
-            const userNextSong = data.user_next_song;
-            const raffleWinnerAlreadySang = data.raffle_winner_already_sang;
-            var wait_text;
-
-            if (userNextSong && !raffleWinnerAlreadySang) {
-                const wait_amount = userNextSong.wait_amount
-                dashboardElem.classList.remove("hidden");
-                noSongElem.classList.add("hidden");
-
-                if (wait_amount === null){
-                    wait_text = "(not in the lineup yet)";
-                }
-                else if (wait_amount === 0) {
-                    wait_text = "(get ready, you're up next!)";
-                }
-                else {
-                    wait_text = `(coming up in ${wait_amount} songs)`;
-                }
-
-                document.getElementById(
-                    "user-next-song-title"
-                ).innerHTML = `Your next song ${wait_text}:`
-
-                document.getElementById("user-next-song-name").innerHTML =
-                    userNextSong.name;
-            } else {
-                dashboardElem.classList.add("hidden");
-                noSongElem.classList.remove("hidden");
-            }
-        });
+function populateDashboard(state) {
+    const data = state.dashboard;
+    if (!data) {
+        return;
+    }
+
+    const userNextSong = data.user_next_song;
+    const raffleWinnerAlreadySang = data.raffle_winner_already_sang;
+    var wait_text;
+
+    if (userNextSong && !raffleWinnerAlreadySang) {
+        const wait_amount = userNextSong.wait_amount
+        dashboardElem.classList.remove("hidden");
+        noSongElem.classList.add("hidden");
+
+        if (wait_amount === null){
+            wait_text = "(not in the lineup yet)";
+        }
+        else if (wait_amount === 0) {
+            wait_text = "(get ready, you're up next!)";
+        }
+        else {
+            wait_text = `(coming up in ${wait_amount} songs)`;
+        }
+
+        document.getElementById(
+            "user-next-song-title"
+        ).innerHTML = `Your next song ${wait_text}:`
+
+        document.getElementById("user-next-song-name").innerHTML =
+            userNextSong.name;
+    } else {
+        dashboardElem.classList.add("hidden");
+        noSongElem.classList.remove("hidden");
+    }
 }
 
 if (isSinger) {
-    setInterval(populateDashboard, 1000);
-    window.addEventListener("DOMContentLoaded", loadWait(populateDashboard));
+    onStageState(populateDashboard);
 
     // Open up dashboard tips
     const tips = document.getElementById("home-tips");
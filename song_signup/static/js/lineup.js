@@ -1,4 +1,5 @@
 import { loadWait } from "./utils.js";
+import { onStageState, refreshStageState } from "./stage-state.js";
 
 // Explanation menu
 const overlay = document.getElementById("explanation-overlay");
@@ -17,8 +18,8 @@ overlay.addEventListener("click", expandExplanation);
 
 
 // Populate lineup data
-setInterval(populateLineup, 1000);
-window.addEventListener('DOMContentLoaded', loadWait(populateLineup));
+onStageState(populateLineup);
+window.addEventListener('DOMContentLoaded', loadWait(refreshStageState));
 
 function formatSong(song, current_song = false) {
     let content;
@@ -44,12 +45,14 @@ function formatSong(song, current_song = false) {
 const currentlySinging = document.getElementById("currently-singing");
 const linupList = document.getElementById("lineup-list");
 const nowPerforming = document.getElementById("now-performing");
+let lineupVersion = null;
 
-async function populateLineup() {
-    const startedRes = await fetch("/evening_started");
-    const eveningStarted = (await startedRes.json()).started
+async function populateLineup(state) {
+    if (state.version === lineupVersion) {
+        return; // Nothing changed since we last drew the lineup
+    }
 
-    if (!eveningStarted) {
+    if (!state.started) {
         currentlySinging.innerHTML = `
         <div class="song-wrapper">
             <div class="song-details">
@@ -60,6 +63,7 @@ async function populateLineup() {
         `
         nowPerforming.classList.add('hidden');
         linupList.classList.add('hidden');
+        lineupVersion = state.version;
         return;
     } else {
         nowPerforming.classList.remove('hidden');
@@ -67,6 +71,9 @@ async function populateLineup() {
     }
 
     const res = await fetch("/get_lineup");
+    if (!res.ok) {
+        throw new Error(`Failed to fetch the lineup: ${res.status}`);
+    }
     const data = await res.json();
 
     currentlySinging.innerHTML = formatSong(data.current_song, true);
@@ -90,5 +97,7 @@ async function populateLineup() {
     } else {
         linupList.innerHTML = '';
     }
+    // Only once drawn - if fetching the lineup failed, the next poll tries again
+    lineupVersion = state.version;
 }
 
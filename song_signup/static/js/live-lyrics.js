@@ -1,3 +1,5 @@
+import { onStageState } from "./stage-state.js";
+
 const lyricsText = document.getElementById("lyrics-text");
 const lyricsWrapper = document.getElementById("lyrics-wrapper");
 const nav = document.querySelector("nav");
@@ -26,6 +28,9 @@ let fireworksInstance = null;
 let fireworksRunning = false;
 const rafflePhaseNumber = document.getElementById("raffle-phase-number");
 let currentSong = '';
+let cachedLyrics = null;
+let lyricsVersion = null;
+let renderedLyrics = null; // The lyrics currently in lyricsText, so an unchanged song isn't rendered again
 let showPasscode = false;
 let activeRaffleWinner = false;
 let slotAnimationRunning = false;
@@ -98,19 +103,43 @@ Bo-bo, bo-bo-bo, whoa!
 </pre>
 `
 
-setInterval(populateLyrics, 1000);
+onStageState(populateLyrics, { liveLyrics: true });
+
+async function fetchLyrics(version) {
+    // The lyrics have a version of their own, so they're not part of the state - fetched again only when it changes.
+    // A new version isn't always new lyrics (e.g. alternative lyrics were found): we send the hash of the lyrics we have,
+    // and only get them again if it changed
+    if (version !== lyricsVersion) {
+        const params = cachedLyrics?.hash ? `?hash=${cachedLyrics.hash}` : "";
+        const response = await fetch(`/current_lyrics${params}`);
+        const lyricsData = await response.json();
+        if (!lyricsData.unchanged) {
+            cachedLyrics = lyricsData;
+        }
+        lyricsVersion = version;
+    }
+    return cachedLyrics;
+}
+
+function highlightDrinkingWords(lyrics, spans) {
+    // The server finds the drinking words (once per song) - we only wrap them
+    const parts = [];
+    let position = 0;
+    for (const [start, end] of spans) {
+        parts.push(lyrics.slice(position, start), `<span class="drink-highlight">${lyrics.slice(start, end)}</span>`);
+        position = end;
+    }
+    parts.push(lyrics.slice(position));
+    return parts.join('');
+}
 
-async function populateLyrics() {
-    const startedRes = await fetch("/evening_started");
-    const eveningStarted = (await startedRes.json()).started;
-    const bohoRes = await fetch("/boho_started");
-    const boho = (await bohoRes.json()).boho;
-    const questionRes = await fetch("/get_active_question");
-    const question = await questionRes.json();
-    const raffleParticipantsRes = await fetch("/get_raffle_participants");
-    const raffleParticipants = await raffleParticipantsRes.json();
+async function populateLyrics(state) {
+    const eveningStarted = state.started;
+    const boho = state.boho;
+    const question = state.active_question;
+    const raffleParticipants = state.raffle_participants;
 
-    if (questionRes.status === 200 && Object.keys(question).length > 0 && isSuperuser) {
+    if (Object.keys(question).length > 0 && isSuperuser) {
         const winner = question.winner;
         const image = question.image
 
@@ -157,10 +186,8 @@ async function populateLyrics() {
     }
 
     // Only show raffle view if participants list is non-empty (backend only returns list if active winner exists)
-    const hasParticipants = raffleParticipantsRes.status === 200 &&
-        raffleParticipants &&
-        Array.isArray(raffleParticipants.participants) &&
-        raffleParticipants.participants.length > 0 &&
+    const hasParticipants = Array.isArray(raffleParticipants) &&
+        raffleParticipants.length > 0 &&
         isSuperuser;
 
     if (hasParticipants) {
@@ -173,7 +200,7 @@ async function populateLyrics() {
         // Start slot machine animation (only once, if not already completed)
         if (!slotAnimationRunning && !slotAnimationCompleted) {
             slotAnimationRunning = true;
-            runSlotMachineAnimation(raffleParticipants.participants);
+            runSlotMachineAnimation(raffleParticipants);
         }
         raffleParticipantsWrapper.classList.remove("hidden");
     }
@@ -217,6 +244,7 @@ async function populateLyrics() {
         logo.classList.add('not-started');
         logo_img.src = logo.getAttribute('data-big-logo');
         lyricsText.innerHTML = ""
+        renderedLyrics = null;
 
         if (showPasscode) {
             const passcodeRes = await fetch("/passcode");
@@ -238,6 +266,7 @@ async function populateLyrics() {
 
     if (boho) {
         lyricsText.innerHTML = bohoDaysLyrics;
+        renderedLyrics = null;
         logo.classList.add('hidden');
         if (!lyricsWrapper.classList.contains('boho')) {
             document.body.scrollTop = document.documentElement.scrollTop = 0;
@@ -253,8 +282,7 @@ async function populateLyrics() {
     }
 
 
-    const lyricsRes = await fetch("/current_lyrics");
-    const lyricsData = await lyricsRes.json();
+    const lyricsData = await fetchLyrics(state.lyrics_version);
     const isGroupSong = lyricsData.is_group_song;
 
     if (isGroupSong) {
@@ -262,22 +290,9 @@ async function populateLyrics() {
     } else {
         lyricsWrapper.classList.remove('group-song');
     }
-    if (lyricsData.song_name) {
-        var lyrics = lyricsData.lyrics;
-        const resDrinking = await fetch("/drinking_words");
-        const drinkingWords = (await resDrinking.json()).drinking_words;
-        let regex;
-
-        if (drinkingWords.includes('*')) {
-            regex = new RegExp(`\\b([\\w']+)\\b`, 'gi');
-            lyrics = lyrics.replace(regex, `<span class="drink-highlight">$1</span>`);
-        }
-        else {
-            drinkingWords.forEach(word => {
-                regex = new RegExp(`\\b(${word}s?)\\b`, 'gi');
-                lyrics = lyrics.replace(regex, `<span class="drink-highlight">$1</span>`);
-            })
-        }
+    if (lyricsData.song_name && lyricsData !== renderedLyrics) {
+        renderedLyrics = lyricsData;
+        const lyrics = highlightDrinkingWords(lyricsData.lyrics, lyricsData.drinking_spans);
 
         lyricsText.innerHTML = `${isGroupSong ? "<div id='group-song-title'>GROUP SONG!!!</div>" : ""}
         <h2>${lyricsData.song_name}</h2>
@@ -0,0 +1,93 @@
+// A single poll of /stage_state per page, shared by every script that needs the state of the stage.
+// While the /stage_events push channel is up, we only fetch the state when it announces a new version (and poll
+// slowly as a safety net). Without it - an old browser, or a server without the channel - we poll every second, or
+// as rarely as the server asks us to (X-Poll-Interval) when it's under load.
+const POLL_INTERVAL = 1000;
+const PUSHED_POLL_INTERVAL = 15000;
+
+const subscribers = [];
+const params = new URLSearchParams();
+let polling = false;
+let pending = false;
+let timer = null;
+let events = null;
+let pushed = false;
+let version = null;
+let pollInterval = POLL_INTERVAL;
+
+export function onStageState(callback, { liveLyrics = false } = {}) {
+    subscribers.push(callback);
+    if (liveLyrics) {
+        params.set("live_lyrics", "true");
+    }
+    if (!timer) {
+        subscribeToEvents();
+        schedulePoll();
+    }
+}
+
+function schedulePoll() {
+    clearTimeout(timer);
+    timer = setTimeout(async () => {
+        try {
+            await refreshStageState();
+        } finally {
+            schedulePoll(); // Keep polling whatever happened to this poll
+        }
+    }, pushed ? Math.max(PUSHED_POLL_INTERVAL, pollInterval) : pollInterval);
+}
+
+function subscribeToEvents() {
+    if (!window.EventSource || events) {
+        return;
+    }
+
+    events = new EventSource("/stage_events");
+    events.addEventListener("open", () => {
+        pushed = true;
+        schedulePoll();
+    });
+    events.addEventListener("error", () => {
+        // The browser reconnects by itself (unless the server refused the stream) - poll in the meantime
+        pushed = false;
+        schedulePoll();
+    });
+    events.addEventListener("stage", (event) => {
+        if (Number(event.data) !== version) {
+            // When the server asks us to back off, spread the phones' fetches over the interval instead of all
+            // fetching the moment the version changes
+            const delay = pollInterval > POLL_INTERVAL ? Math.random() * pollInterval : 0;
+            setTimeout(refreshStageState, delay);
+        }
+    });
+}
+
+export async function refreshStageState() {
+    if (polling) {
+        pending = true; // The previous poll is still in flight, and may have missed the latest change
+        return;
+    }
+
+    polling = true;
+    try {
+        const response = await fetch(`/stage_state?${params}`);
+        pollInterval = Number(response.headers.get("X-Poll-Interval")) || POLL_INTERVAL;
+        if (response.status !== 200) {
+            return;
+        }
+        const state = await response.json();
+        version = state.version;
+        for (const callback of subscribers) {
+            await callback(state);
+        }
+    } catch (error) {
+        // A failed fetch (the phone lost the network) or a failing subscriber - try again on the next poll
+        console.error("Failed to refresh the stage state", error);
+    } finally {
+        polling = false;
+        if (pending) {
+            pending = false;
+            refreshStageState();
+        }
+    }
+}
@@ -1,4 +1,7 @@
+import asyncio
 import dataclasses
+import hashlib
+import json
 import os
 import re
 import time
@@ -10,9 +13,14 @@ import bs4
 import requests
 import sherlock
 from celery import shared_task
+from django.conf import settings
 from redis import Redis
 
-from .models import GroupSongRequest, SongLyrics, SongRequest
+from twist.utils import get_redis
+
+from .lyrics_engine import run_providers
+from .models import GroupSongRequest, LibraryLyrics, Singer, SongLyrics, SongRequest, _normalize_string
+from .stage import bump_stage_version
 
 logger = getLogger(__name__)
 
@@ -46,6 +54,7 @@ sherlock.configure(
 
 # Using Serper (Google Search API) as a replacement for Exa
 SERPER_ENDPOINT = "https://google.serper.dev/search"
+SEARCH_ATTEMPTS = 3  # Searches sometimes come back empty, and then find results when retried
 
 @dataclasses.dataclass
 class LyricsResult:
@@ -54,34 +63,90 @@ class LyricsResult:
     artist: str
     url: str | None
 
-#############################################################################
-### MAKE SURE TO ADD NEW WORKER TO start-celery.sh WHEN ADDING NEW PARSER ###
-###########################################################################
+
+def search_query(song_name, author):
+    return '{} lyrics {}'.format(song_name, author)
+
+
+def serper_batch(queries):
+    """One Serper request for several queries - returns the result links of each query, in order"""
+    response = requests.post(
+        SERPER_ENDPOINT,
+        headers={"X-API-KEY": serper_key, "Content-Type": "application/json"},
+        json=[{"q": query} for query in queries],
+        timeout=10,
+    )
+    response.raise_for_status()
+    return [[result.get("link", "") for result in results.get("organic", [])] for results in response.json()]
+
+
+def search_sites(query, sites):
+    """
+    Search each of the sites for the query (restricted with a `site:` operator, mirroring Exa's include_domains) - in
+    a single Serper request for all of them, retrying the sites that found nothing.
+    Search results are cached per site and query, so repeated searches (a song sung again, lyrics refreshed, a song
+    name edited back) don't pay for Serper again. Empty results are cached too, for less time.
+    Returns {site: result links}.
+    """
+    # For testing - use query: "mama I'm a big girl now lyrics hairspray" with site allmusicals.com
+    sites = list(dict.fromkeys(sites))
+    query_hash = hashlib.sha1(_normalize_string(query).encode()).hexdigest()
+    keys = {site: f"serper:{site}:{query_hash}" for site in sites}
+
+    redis = get_redis()
+    results = {site: json.loads(cached) for site, cached in zip(sites, redis.mget(keys.values()))
+               if cached is not None}
+    missing = [site for site in sites if site not in results]
+    failed = set()
+
+    for attempt in range(SEARCH_ATTEMPTS):
+        if not missing:
+            break
+        if attempt:
+            logger.info(f"No search results from {', '.join(missing)}, retrying")
+
+        try:
+            batch = serper_batch([f"{query} site:{site}" for site in missing])
+        except requests.HTTPError as e:
+            logger.error(f"Serper search failed: HTTP {e.response.status_code} - {e.response.text}")
+            failed = set(missing)
+            continue
+        except Exception:
+            logger.exception("Serper search failed")
+            failed = set(missing)
+            continue
+
+        failed = set()
+        results.update(zip(missing, batch))
+        missing = [site for site in missing if not results[site]]
+
+    with redis.pipeline() as pipe:
+        for site, links in results.items():
+            if site in failed:
+                continue  # Not cached - a failed search may well work next time
+            timeout = settings.SERPER_CACHE_TIMEOUT if links else settings.SERPER_EMPTY_CACHE_TIMEOUT
+            pipe.set(keys[site], json.dumps(links), ex=timeout)
+        pipe.execute()
+
+    return {site: [] if site in failed else results.get(site, []) for site in sites}
+
+
 class LyricsWebsiteParser:
     URL_FORMAT = re.compile("")
     SITE = ""
+    SEARCHED = True  # Finds its lyrics pages with a search (see search_sites)
 
     def serper_search(self, query):
-        # For testing - use query: "mama I'm a big girl now lyrics hairspray site:allmusicals.com"
-        # Restrict to this parser's site via a `site:` operator, mirroring Exa's include_domains.
-        try:
-            response = requests.post(
-                SERPER_ENDPOINT,
-                headers={"X-API-KEY": serper_key, "Content-Type": "application/json"},
-                json={"q": f"{query} site:{self.SITE}"},
-                timeout=10,
-            )
-            response.raise_for_status()
-            return [result.get("link", "") for result in response.json().get("organic", [])]
-        except requests.HTTPError as e:
-            logger.error(
-                f"Serper search failed for {self.SITE}: HTTP {e.response.status_code} - {e.response.text}"
-            )
-            return []
-        except Exception:
-            logger.exception(f"Serper search failed for {self.SITE}")
-            return []
+        return search_sites(query, [self.SITE])[self.SITE]
 
+    def search_urls(self, search_results):
+        """The lyrics pages among the search results"""
+        urls = []
+        for search_result in search_results:
+            url = self.fix_url(search_result)
+            if url not in urls and self.URL_FORMAT.search(url):
+                urls.append(url)
+        return urls
 
     def fix_url(self, url):
         # Perform any necessary fixups on URL before requesting
@@ -90,60 +155,105 @@ class LyricsWebsiteParser:
     def parse_lyrics(self, soup: bs4.BeautifulSoup) -> Optional[LyricsResult]:
         return None
 
-    def get_url(self, url: str) -> requests.Response:
-        return requests.get(url, headers={"User-Agent": USER_AGENT})
+    def get_url(self, url: str, headers: dict | None = None) -> requests.Response:
+        return requests.get(url, headers={"User-Agent": USER_AGENT, **(headers or {})})
 
-    def get_lyrics(self, song_name: str, author: str) -> Iterable[LyricsResult]:
-        lock = sherlock.Lock(self.SITE)
-        seen_urls = set()
-        search_query = '{} lyrics {}'.format(song_name, author)
+    @staticmethod
+    def _page_key(url):
+        return f"page:{hashlib.sha1(url.encode()).hexdigest()}"
 
-        for _ in range(3):
-            search_results = self.serper_search(search_query)
-            if len(search_results) > 0:
-                break
-            logger.info("No search results, retrying")
+    def cached_page(self, url: str) -> dict:
+        """What we kept of the page - its validators and the lyrics parsed from it (not the page itself)"""
+        return {field.decode(): value.decode() for field, value in get_redis().hgetall(self._page_key(url)).items()}
 
-        for search_result in search_results:
-            url = self.fix_url(search_result)
+    def fetch_page(self, url: str, lock: sherlock.Lock, cached: dict) -> Optional[requests.Response]:
+        """
+        The response for the page (200, or 304 if it didn't change since it was cached), or None if it couldn't be
+        fetched
+        """
+        headers = {}
+        if cached.get('etag'):
+            headers["If-None-Match"] = cached['etag']
+        if cached.get('last_modified'):
+            headers["If-Modified-Since"] = cached['last_modified']
 
-            if url in seen_urls:
-                continue
-            seen_urls.add(url)
+        lock.acquire()  # Expires on its own after an interval (for throttling)
+        logger.info(f"Performing query on {url}")
 
-            if not self.URL_FORMAT.search(url):
-                continue
+        try:
+            r = self.get_url(url, headers)
+        except Exception:
+            logger.exception(f"Received exception when requesting URL {url}")
+            return None
 
-            lock.acquire()  # Expires on its own after an interval (for throttling)
-            logger.info(f"Performing query on {url}")
+        if r.status_code == 200 or (r.status_code == 304 and cached):
+            return r
+        logger.warning(f"Received status {r.status_code} for URL {url}")
+        return None
 
-            try:
-                r = self.get_url(url)
-            except Exception:
-                logger.exception(f"Received exception when requesting URL {url}")
+    def remember_page(self, url: str, r: requests.Response, cached: dict, result: LyricsResult):
+        key = self._page_key(url)
+        redis = get_redis()
+        redis.hset(key, mapping={
+            'fetched_at': time.time(),
+            'etag': r.headers.get("ETag", cached.get('etag', '')),
+            'last_modified': r.headers.get("Last-Modified", cached.get('last_modified', '')),
+            'title': result.title,
+            'artist': result.artist,
+            'lyrics': result.lyrics,
+        })
+        redis.expire(key, settings.PAGE_CACHE_TIMEOUT)
+
+    def forget_page(self, url: str):
+        """A page we couldn't parse (e.g. a "you're blocked" page) shouldn't be served from the cache"""
+        get_redis().delete(self._page_key(url))
+
+    def get_lyrics(self, song_name: str, author: str, urls: list[str] | None = None) -> Iterable[LyricsResult]:
+        """
+        `urls` - the lyrics pages, when the song was already searched for (see the get_lyrics task).
+        The lyrics of a page are cached - served without a request while fresh (so known songs don't wait for the
+        throttle), and revalidated with a conditional request (ETag / Last-Modified) after that.
+        """
+        lock = sherlock.Lock(self.SITE)
+        if urls is None:
+            urls = self.search_urls(self.serper_search(search_query(song_name, author)))
+
+        for url in urls:
+            cached = self.cached_page(url)
+            if cached and time.time() - float(cached['fetched_at']) < settings.PAGE_CACHE_FRESH:
+                yield LyricsResult(lyrics=cached['lyrics'], title=cached['title'], artist=cached['artist'], url=url)
                 continue
 
-            if not r.status_code == 200:
-                logger.warning(f"Received status {r.status_code} for URL {url}")
+            r = self.fetch_page(url, lock, cached)
+            if r is None:
                 continue
 
-            soup = bs4.BeautifulSoup(r.text, features="html.parser")
+            if r.status_code == 304:
+                result = LyricsResult(lyrics=cached['lyrics'], title=cached['title'], artist=cached['artist'],
+                                      url=url)
+            else:
+                soup = bs4.BeautifulSoup(r.text, features="html.parser")
 
-            try:
-                result = self.parse_lyrics(soup)
+                try:
+                    result = self.parse_lyrics(soup)
+                except Exception as e:
+                    # Skip exceptions in individual parsers
+                    logger.exception(f"Exception in parser for url {url}")
+                    self.forget_page(url)
+                    continue
 
                 if not result:
                     logger.warning(
-                        f"Unable to parse search result {search_result}"
+                        f"Unable to parse search result {url}"
                     )
+                    self.forget_page(url)
                     # Something is broken in the parser, let's skip it
                     break
 
                 result.url = url
-                yield result
-            except Exception as e:
-                # Skip exceptions in individual parsers
-                logger.exception(f"Exception in parser for url {search_result}")
+
+            self.remember_page(url, r, cached, result)
+            yield result
 
 
 class GeniusExaParser(LyricsWebsiteParser):
@@ -189,6 +299,7 @@ class GeniusApiParser(LyricsWebsiteParser):
     """
     URL_FORMAT = re.compile("genius\.com")
     SITE = "genius.com"
+    SEARCHED = False  # Searches the Genius API itself
 
     @property
     def api_headers(self):
@@ -212,9 +323,8 @@ class GeniusApiParser(LyricsWebsiteParser):
         res = requests.get(endpoint, params=params, headers=self.api_headers)
         return res.json()['lyrics']
 
-    def get_lyrics(self, song_name: str, author: str) -> Iterable[LyricsResult]:
-        search_query = f"{author} {song_name}"
-        song_ids = self.search_api(search_query)
+    def get_lyrics(self, song_name: str, author: str, urls: list[str] | None = None) -> Iterable[LyricsResult]:
+        song_ids = self.search_api(f"{author} {song_name}")
         for song_id in song_ids:
             try:
                 res = self.lyric_api(song_id)
@@ -243,9 +353,9 @@ class AllMusicalsParser(LyricsWebsiteParser):
     URL_FORMAT = re.compile("allmusicals\.com\/lyrics\/.*\.htm$")
     SITE = "allmusicals.com"
 
-    def get_url(self, url: str) -> requests.Response:
+    def get_url(self, url: str, headers: dict | None = None) -> requests.Response:
         # AllMusicals is using a cert that is not always trusted
-        return requests.get(url, headers={"User-Agent": USER_AGENT}, verify=False)
+        return requests.get(url, headers={"User-Agent": USER_AGENT, **(headers or {})}, verify=False)
 
     def parse_lyrics(self, soup: bs4.BeautifulSoup) -> LyricsResult:
         page_title = soup.find("title").text
@@ -292,7 +402,7 @@ class AzLyricsParser(LyricsWebsiteParser):
         self.session = requests.Session()
         self.session.headers.update(BROWSER_HEADERS)
 
-    def get_url(self, url: str) -> requests.Response:
+    def get_url(self, url: str, headers: dict | None = None) -> requests.Response:
         # Use session with browser-like headers to avoid being blocked
         if not hasattr(self, '_session_initialized'):
             # First visit homepage to establish session and cookies
@@ -321,13 +431,13 @@ class AzLyricsParser(LyricsWebsiteParser):
             referer = "https://www.azlyrics.com/"
         
         # Update Referer to make request appear to come from browsing the site
-        headers = BROWSER_HEADERS.copy()
-        headers["Referer"] = referer
+        request_headers = {**BROWSER_HEADERS, **(headers or {})}
+        request_headers["Referer"] = referer
         
         # Small delay before request to avoid appearing automated
         time.sleep(0.3)
         
-        return self.session.get(url, headers=headers, timeout=10)
+        return self.session.get(url, headers=request_headers, timeout=10)
 
     def parse_lyrics(self, soup: bs4.BeautifulSoup) -> Optional[LyricsResult]:
         page_title = soup.find("title").text
@@ -460,7 +570,22 @@ PARSERS = {parser.__name__: parser for parser in LyricsWebsiteParser.__subclasse
 
 
 @shared_task
-def get_lyrics(song_id: int | None = None, group_song_id: int | None = None):
+def recalculate_positions():
+    Singer.ordering.run_pending_recalculation()
+
+
+@shared_task
+def reveal_trivia_winner():
+    # The winner of a trivia question only shows once their answer is old enough (see TriviaQuestion.winner)
+    bump_stage_version()
+
+
+@shared_task
+def get_lyrics(song_id: int | None = None, group_song_id: int | None = None, refresh: bool = False):
+    """
+    Songs that were sung on an earlier evening get their lyrics from the library. `refresh` searches again anyway
+    (keeping only the library's default lyrics).
+    """
     if song_id is not None:
         assert group_song_id is None
         song = SongRequest.objects.get(id=song_id)
@@ -474,13 +599,52 @@ def get_lyrics(song_id: int | None = None, group_song_id: int | None = None):
         # Delete old lyrics
         SongLyrics.objects.filter(group_song_request=song).delete()
 
-    for parser_name in PARSERS:
-        get_lyrics_for_provider.apply_async(args=(parser_name, song_id, group_song_id), queue=f'parser_{parser_name}_queue')
+    library = LibraryLyrics.objects.for_song(song)
+    if refresh:
+        library.filter(default=False).delete()
+    else:
+        library_lyrics = list(library)
+        if library_lyrics:
+            logger.info(f"Found {len(library_lyrics)} lyrics for {song.song_name} in the library")
+            for lyrics in library_lyrics:
+                lyrics.to_song_lyrics(song, is_group_song=group_song_id is not None).save()
+            if any(lyrics.default for lyrics in library_lyrics):
+                type(song).objects.filter(pk=song.pk).update(default_lyrics=True)
+            return
+
+    # The search and the fetches are all slow requests - keep them off the queue of the lineup tasks
+    fetch_lyrics.apply_async(args=(song_id, group_song_id), queue='lyrics_queue')
+
+
+def lyrics_providers(song) -> dict:
+    """{parser name: (site, lyrics page URLs)} - one search for all the parsers' sites, rather than a search by each"""
+    searched_sites = [parser.SITE for parser in PARSERS.values() if parser.SEARCHED]
+    search_results = search_sites(search_query(song.song_name, song.musical), searched_sites)
+
+    providers = {}
+    for parser_name, parser in PARSERS.items():
+        urls = parser().search_urls(search_results[parser.SITE]) if parser.SEARCHED else None
+        providers[parser_name] = (parser.SITE, urls)
+    return providers
+
+
+@shared_task
+def fetch_lyrics(song_id: int | None, group_song_id: int | None):
+    """Search for the song's lyrics, and fetch them from all the providers concurrently"""
+    if song_id is not None:
+        song = SongRequest.objects.get(id=song_id)
+    else:
+        song = GroupSongRequest.objects.get(id=group_song_id)
+
+    asyncio.run(run_providers(
+        {parser_name: (site, (song_id, group_song_id, urls))
+         for parser_name, (site, urls) in lyrics_providers(song).items()},
+        fetch_provider_lyrics,
+    ))
 
 
-@shared_task(rate_limit="0.5/s")
-def get_lyrics_for_provider(
-    parser_name: str, song_id: int | None, group_song_id: int | None
+def fetch_provider_lyrics(
+    parser_name: str, song_id: int | None, group_song_id: int | None, urls: list[str] | None = None
 ):
     parser = PARSERS[parser_name]
 
@@ -491,8 +655,8 @@ def get_lyrics_for_provider(
         assert group_song_id is not None
         song = GroupSongRequest.objects.get(id=group_song_id)
 
-    for i, result in enumerate(parser().get_lyrics(song.song_name, song.musical)):
-        SongLyrics.objects.create(
+    for i, result in enumerate(parser().get_lyrics(song.song_name, song.musical, urls)):
+        lyrics = SongLyrics.objects.create(
             song_name=result.title,
             artist_name=result.artist,
             url=result.url,
@@ -500,6 +664,11 @@ def get_lyrics_for_provider(
             song_request=song if song_id is not None else None,
             group_song_request=song if group_song_id is not None else None,
         )
+        if LibraryLyrics.objects.add(song, lyrics).default:
+            # Refreshed - these are still the lyrics that were chosen for the song
+            lyrics.default = True
+            lyrics.save()
+            type(song).objects.filter(pk=song.pk).update(default_lyrics=True)
 
         # 3 lyrics per site
         if i == 2:
@@ -1,7 +1,17 @@
+import re
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from freezegun import freeze_time
 from mock import patch
 
+from song_signup.admin import set_solo_skipped, set_solo_unskipped
 from song_signup.models import Singer, SongRequest
+from song_signup.ordering import SingerRecord, SongRecord, calculate_lineup, next_songs, order_singers
 from song_signup.tests.utils_for_tests import (
     SongRequestTestCase, TEST_START_TIME, create_singers, assert_singers_in_disney,
     set_performed, add_partners, add_songs_to_singers, get_singer, assert_song_positions, add_songs_to_singer,
@@ -317,6 +327,167 @@ class TestCalculatePositionsDisney(SongRequestTestCase):
             ])
 
 
+def _position_updates(queries):
+    """
+    Return the ids of songs whose position was written, asserting that it was done in at most one statement
+    """
+    updates = [query['sql'] for query in queries
+               if query['sql'].startswith('UPDATE "song_signup_songrequest"') and '"position"' in query['sql']]
+    assert len(updates) <= 1, f"Positions were written in {len(updates)} statements"
+    if not updates:
+        return set()
+
+    song_ids = re.search(r'"song_signup_songrequest"\."id" IN \(([\d, ]+)\)', updates[0]).group(1)
+    return {int(song_id) for song_id in song_ids.split(',')}
+
+
+class TestIncrementalPositions(SongRequestTestCase):
+    def test_unchanged_lineup_writes_nothing(self):
+        with freeze_time(TEST_START_TIME, auto_tick_seconds=5) as frozen_time:
+            create_singers(5, frozen_time, num_songs=1)
+
+            with CaptureQueriesContext(connection) as ctx:
+                Singer.ordering.calculate_positions()
+
+            self.assertEqual(_position_updates(ctx.captured_queries), set())
+            assert_song_positions(self, [(1, 1), (2, 1), (3, 1), (4, 1), (5, 1)])
+
+    def test_new_singer_writes_only_new_slot(self):
+        with freeze_time(TEST_START_TIME, auto_tick_seconds=5) as frozen_time:
+            create_singers(5, frozen_time, num_songs=1)
+            [new_singer] = create_singers([6], frozen_time)
+            SongRequest.objects.create(song_name="song_6_1", musical="Wicked", singer=new_singer)
+
+            with CaptureQueriesContext(connection) as ctx:
+                Singer.ordering.calculate_positions()
+
+            self.assertEqual(_position_updates(ctx.captured_queries), {get_song(6, 1).pk})
+            assert_song_positions(self, [(1, 1), (2, 1), (3, 1), (4, 1), (5, 1), (6, 1)])
+
+    def test_removed_song_shifts_only_later_songs(self):
+        with freeze_time(TEST_START_TIME, auto_tick_seconds=5) as frozen_time:
+            create_singers(5, frozen_time, num_songs=1)
+            get_song(3, 1).delete()
+
+            with CaptureQueriesContext(connection) as ctx:
+                Singer.ordering.calculate_positions()
+
+            # Songs of singers 4 and 5 move up a slot, 1 and 2 stay where they are
+            self.assertEqual(_position_updates(ctx.captured_queries), {get_song(4, 1).pk, get_song(5, 1).pk})
+            assert_song_positions(self, [(1, 1), (2, 1), (4, 1), (5, 1)])
+
+    def test_logged_out_singer_unscheduled(self):
+        with freeze_time(TEST_START_TIME, auto_tick_seconds=5) as frozen_time:
+            create_singers(3, frozen_time, num_songs=1)
+            logout(3)
+
+            with CaptureQueriesContext(connection) as ctx:
+                Singer.ordering.calculate_positions()
+
+            self.assertEqual(_position_updates(ctx.captured_queries), {get_song(3, 1).pk})
+            self.assertIsNone(get_song(3, 1).position)
+            assert_song_positions(self, [(1, 1), (2, 1)])
+
+
+class TestOrderingQueryCount(SongRequestTestCase):
+    """
+    Resolving the lineup shouldn't issue queries per singer - the number of queries has to stay the same no matter
+    how many singers are in the lineup.
+    """
+    def _assert_constant_queries(self, num_singers):
+        with freeze_time(TEST_START_TIME, auto_tick_seconds=5) as frozen_time:
+            create_singers(num_singers, frozen_time, num_songs=2)
+            set_performed(1, 1, frozen_time)
+            logout(2)
+
+            # The whole lineup shifts, and is written in a single statement: savepoint, lock, songs, ordering (flags +
+            # singers), positions update, snapshots read, outdated snapshots delete, new snapshots insert, release
+            with self.assertNumQueries(10):
+                Singer.ordering.calculate_positions()
+
+            # Flags lookup + the annotated singers query
+            with self.assertNumQueries(2):
+                Singer.ordering.singer_disneyland_ordering()
+
+            with self.assertNumQueries(1):
+                Singer.ordering.active_singers()
+
+            with self.assertNumQueries(1):
+                Singer.ordering.new_singers_num()
+
+            # Lineup is up to date, so nothing is written: savepoint, lock, songs, ordering (flags + singers),
+            # snapshots read, release
+            with self.assertNumQueries(7):
+                Singer.ordering.calculate_positions()
+
+            # The user (not cached inside the test's transaction) and the singer's snapshot - the session is in Redis
+            self.client.force_login(get_singer(num_singers))
+            with self.assertNumQueries(2):
+                self.client.get(reverse('dashboard_data'))
+
+    def test_few_singers(self):
+        self._assert_constant_queries(3)
+
+    def test_many_singers(self):
+        self._assert_constant_queries(30)
+
+    def test_closed_signup(self):
+        disable_flag('CAN_SIGNUP')
+        self._assert_constant_queries(30)
+
+
+class TestOrderingCore(SimpleTestCase):
+    # Times are plain ints here - the ordering only compares them
+    SINGERS = [
+        SingerRecord(pk=1, first_request_at=1, last_performance_at=5),
+        SingerRecord(pk=2, first_request_at=2),
+        SingerRecord(pk=3, first_request_at=3, last_performance_at=4),
+        SingerRecord(pk=4, first_request_at=6),
+        SingerRecord(pk=5, first_request_at=0, is_audience=True),  # Raffle winner
+    ]
+
+    def test_open_signup(self):
+        self.assertEqual([singer.pk for singer in order_singers(self.SINGERS, can_signup=True)], [2, 3, 1, 4])
+
+    def test_closed_signup(self):
+        self.assertEqual([singer.pk for singer in order_singers(self.SINGERS, can_signup=False)], [2, 4, 3, 1])
+
+    def test_positions(self):
+        songs = [
+            SongRecord(pk=10, singer_pk=1, priority=2),
+            SongRecord(pk=11, singer_pk=1, priority=1, standby=True),
+            SongRecord(pk=12, singer_pk=2, priority=1),
+            SongRecord(pk=13, singer_pk=3, priority=1, standby=True),
+            SongRecord(pk=14, singer_pk=4, priority=3),
+            SongRecord(pk=15, singer_pk=4, priority=1),
+            SongRecord(pk=16, singer_pk=5, priority=1),
+        ]
+        self.assertEqual(calculate_lineup(self.SINGERS, songs, can_signup=True), {12: 1, 10: 2, 15: 3})
+
+    def test_next_songs(self):
+        songs = [
+            SongRecord(pk=10, singer_pk=1, priority=1, skipped=True),
+            SongRecord(pk=11, singer_pk=1, priority=2),
+            SongRecord(pk=12, singer_pk=2, priority=1, partner_pks=[3]),
+            SongRecord(pk=13, singer_pk=3, priority=1),
+            SongRecord(pk=14, singer_pk=4, priority=2),
+            SongRecord(pk=15, singer_pk=4, priority=1, standby=True),
+        ]
+        positions = {10: 1, 12: 2, 13: 3}
+
+        self.assertEqual(next_songs(songs, positions), {
+            1: (10, 1, -1),  # Skipped, so the current song is the one after it
+            2: (12, 2, 0),
+            3: (12, 2, 0),  # Partner in an earlier song than their own
+            4: (15, None, None),  # Nothing scheduled - the first unscheduled song by priority
+        })
+
+    def test_simulator(self):
+        out = StringIO()
+        call_command('simulate_lineup', '20', '--recalcs', '10', stdout=out)
+        self.assertRegex(out.getvalue(), r"\n\s+20\s+\d+\s+10\s")
+
+
 class TestSimulatedEvenings(SongRequestTestCase):
     def test_scenario1(self):
         # NOTE - This was originally written with the old duet logic which penalized duet singers and counted them as
@@ -826,3 +997,19 @@ class TestDashboard(SongRequestTestCase):
             ExpectedDashboard(singer=2, primary_singer=1, next_song=1, wait_amount=0),
             ExpectedDashboard(singer=3, primary_singer=2, next_song=1, wait_amount=1),
         ])
+
+    def test_skipped_current_song(self):
+        create_singers(3)
+        add_songs_to_singers(3, 1)
+
+        set_solo_skipped(None, None, [get_song(1, 1)])
+        assert_dashboards(self, [
+            ExpectedDashboard(singer=2, next_song=1, wait_amount=0),
+            ExpectedDashboard(singer=3, next_song=1, wait_amount=1),
+        ])
+
+        set_solo_unskipped(None, None, [get_song(1, 1)])
+        assert_dashboards(self, [
+            ExpectedDashboard(singer=2, next_song=1, wait_amount=1),
+            ExpectedDashboard(singer=3, next_song=1, wait_amount=2),
+        ])
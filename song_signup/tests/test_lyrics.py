@@ -1,6 +1,19 @@
-from django.test import TestCase
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, override_settings
+from mock import MagicMock, patch
+
+from song_signup.models import LibraryLyrics, SongLyrics, SongRequest
 from song_signup.tasks import (GeniusExaParser, GeniusApiParser, AllMusicalsParser, ShironetParser,
-                               AzLyricsParser, LyricsTranslateParser, TheMusicalLyricsParser)
+                               AzLyricsParser, LyricsTranslateParser, TheMusicalLyricsParser, LyricsResult,
+                               LyricsWebsiteParser,
+                               get_lyrics, fetch_lyrics, fetch_provider_lyrics, lyrics_providers, search_sites,
+                               PARSERS)
+from song_signup.tests.utils_for_tests import create_singers, get_singer
+from twist.utils import get_redis
 
 
 SONG_NAME = "Hello"
@@ -53,3 +66,284 @@ class TestParsers(TestCase):
         lyrics = list(parser.get_lyrics(SONG_NAME, MUSICAL))
         breakpoint()
 
+
+class TestLyricsLibrary(TestCase):
+    def setUp(self):
+        create_singers(2)
+        self.song = SongRequest.objects.create(song_name='Defying Gravity', musical='Wicked', singer=get_singer(1))
+
+    def _search(self, song, refresh=False):
+        """Fetch lyrics for the song, with a single parser that finds a single result"""
+        results = [LyricsResult(lyrics='Something has changed within me', title='Defying Gravity',
+                                artist='Wicked', url='https://lyrics.com/defying-gravity')]
+        with patch('song_signup.tasks.fetch_lyrics.apply_async') as apply_async, \
+                patch.object(PARSERS['GeniusExaParser'], 'get_lyrics', return_value=results):
+            get_lyrics(song_id=song.id, refresh=refresh)
+            if apply_async.called:
+                fetch_provider_lyrics('GeniusExaParser', song.id, None)
+        return apply_async
+
+    def _next_evening(self):
+        SongRequest.objects.all().delete()
+        return SongRequest.objects.create(song_name='Defying  gravity', musical='wicked', singer=get_singer(2))
+
+    def test_library_hit(self):
+        self._search(self.song)
+        self.assertEqual(LibraryLyrics.objects.count(), 1)
+
+        song = self._next_evening()
+        self.assertEqual(SongLyrics.objects.count(), 0)
+        apply_async = self._search(song)
+
+        apply_async.assert_not_called()
+        lyrics = song.lyrics.get()
+        self.assertEqual((lyrics.song_name, lyrics.lyrics, lyrics.url),
+                         ('Defying Gravity', 'Something has changed within me', 'https://lyrics.com/defying-gravity'))
+        self.assertEqual(LibraryLyrics.objects.count(), 1)
+
+    def test_library_miss(self):
+        self._search(self.song).assert_called_once()
+
+    def test_default_kept(self):
+        self._search(self.song)
+        chosen = SongLyrics.objects.create(song_name='Defying Gravity', artist_name='Idina Menzel',
+                                           lyrics='Unlimited', song_request=self.song)
+        chosen.default = True
+        chosen.save()
+
+        song = self._next_evening()
+        self._search(song)
+        self.assertEqual(song.lyrics.get(default=True).lyrics, 'Unlimited')
+        self.assertEqual(song.lyrics.count(), 2)
+        song.refresh_from_db()
+        self.assertTrue(song.default_lyrics)
+
+    def test_refresh(self):
+        self._search(self.song)
+        chosen = self.song.lyrics.get()
+        chosen.default = True
+        chosen.save()
+        LibraryLyrics.objects.create(song_name='defying gravity', musical='wicked', lyrics_song_name='Other',
+                                     artist_name='', lyrics='Other lyrics')
+
+        with patch('song_signup.tasks.fetch_lyrics.apply_async') as apply_async:
+            get_lyrics(song_id=self.song.id, refresh=True)
+
+        apply_async.assert_called_once()
+        self.assertEqual(list(LibraryLyrics.objects.values_list('lyrics', 'default')),
+                         [('Something has changed within me', True)])
+
+    def test_refresh_keeps_default(self):
+        self._search(self.song)
+        chosen = self.song.lyrics.get()
+        chosen.default = True
+        chosen.save()
+        type(self.song).objects.filter(pk=self.song.pk).update(default_lyrics=False)
+
+        self._search(self.song, refresh=True)
+
+        self.assertEqual(list(LibraryLyrics.objects.values_list('lyrics', 'default')),
+                         [('Something has changed within me', True)])
+        self.song.refresh_from_db()
+        self.assertTrue(self.song.default_lyrics)
+        self.assertTrue(self.song.lyrics.get().default)
+
+    def test_edited_default(self):
+        self._search(self.song)
+        chosen = self.song.lyrics.get()
+        chosen.lyrics = 'Something has changed within me!'
+        chosen.default = True
+        chosen.save()
+
+        self.assertEqual(list(LibraryLyrics.objects.values_list('lyrics', 'default')),
+                         [('Something has changed within me!', True)])
+
+
+class TestSerperCache(TestCase):
+    QUERY = 'Defying Gravity lyrics Wicked'
+    RESULTS = ['https://genius.com/defying-gravity-lyrics']
+
+    def setUp(self):
+        self.redis = get_redis()
+        for key in self.redis.scan_iter('serper:*'):
+            self.redis.delete(key)
+        self.parser = GeniusExaParser()
+
+    def _search(self, query, serper_results):
+        """Search, with Serper returning the given results (or raising) on each request. Returns the results, and the
+        number of requests made"""
+        with patch('song_signup.tasks.serper_batch',
+                   side_effect=[[results] if isinstance(results, list) else results
+                                for results in serper_results]) as serper_batch:
+            results = self.parser.serper_search(query)
+        return results, serper_batch.call_count
+
+    def test_cached(self):
+        self.assertEqual(self._search(self.QUERY, [self.RESULTS]), (self.RESULTS, 1))
+        self.assertEqual(self._search('defying  gravity LYRICS wicked', []), (self.RESULTS, 0))
+
+        # Per site
+        with patch('song_signup.tasks.serper_batch', return_value=[[]]) as serper_batch:
+            AllMusicalsParser().serper_search(self.QUERY)
+        serper_batch.assert_called_with([f'{self.QUERY} site:allmusicals.com'])
+
+    def test_empty_cached(self):
+        self.assertEqual(self._search(self.QUERY, [[], [], []]), ([], 3))
+        self.assertEqual(self._search(self.QUERY, []), ([], 0))
+
+        key = next(self.redis.scan_iter('serper:genius.com:*'))
+        self.assertLessEqual(self.redis.ttl(key), settings.SERPER_EMPTY_CACHE_TIMEOUT)
+
+    def test_retried(self):
+        self.assertEqual(self._search(self.QUERY, [[], self.RESULTS]), (self.RESULTS, 2))
+        self.assertEqual(self._search(self.QUERY, []), (self.RESULTS, 0))
+
+    def test_failure_not_cached(self):
+        self.assertEqual(self._search(self.QUERY, [requests.ConnectionError()] * 3), ([], 3))
+        self.assertEqual(self._search(self.QUERY, [self.RESULTS]), (self.RESULTS, 1))
+
+
+class TestSearchSites(TestCase):
+    QUERY = 'Defying Gravity lyrics Wicked'
+
+    def setUp(self):
+        for key in get_redis().scan_iter('serper:*'):
+            get_redis().delete(key)
+
+    def test_batched(self):
+        sites = ['genius.com', 'allmusicals.com', 'azlyrics.com', 'genius.com']
+        batches = [[['https://genius.com/a'], [], []], [['https://allmusicals.com/b'], []], [[]]]
+        with patch('song_signup.tasks.serper_batch', side_effect=batches) as serper_batch:
+            results = search_sites(self.QUERY, sites)
+
+        self.assertEqual(results, {'genius.com': ['https://genius.com/a'],
+                                   'allmusicals.com': ['https://allmusicals.com/b'], 'azlyrics.com': []})
+        # A single request per attempt, retrying only the sites that found nothing
+        self.assertEqual([call.args[0] for call in serper_batch.call_args_list], [
+            [f'{self.QUERY} site:genius.com', f'{self.QUERY} site:allmusicals.com', f'{self.QUERY} site:azlyrics.com'],
+            [f'{self.QUERY} site:allmusicals.com', f'{self.QUERY} site:azlyrics.com'],
+            [f'{self.QUERY} site:azlyrics.com'],
+        ])
+
+    def test_providers_searched_once(self):
+        create_singers(1)
+        song = SongRequest.objects.create(song_name='Defying Gravity', musical='Wicked', singer=get_singer(1))
+        search_results = {parser.SITE: [] for parser in PARSERS.values()}
+        search_results['genius.com'] = ['https://genius.com/Wicked-defying-gravity-lyrics/q/writer',
+                                        'https://genius.com/albums/Wicked',
+                                        'https://genius.com/Wicked-defying-gravity-lyrics']
+
+        with patch('song_signup.tasks.search_sites', return_value=search_results) as search:
+            providers = lyrics_providers(song)
+
+        search.assert_called_once()
+        urls = {parser_name: urls for parser_name, (site, urls) in providers.items()}
+        self.assertEqual(urls['GeniusExaParser'], ['https://genius.com/Wicked-defying-gravity-lyrics'])
+        self.assertIsNone(urls['GeniusApiParser'])  # Not searched
+        self.assertEqual(urls['AllMusicalsParser'], [])
+
+
+class TestPageCache(TestCase):
+    URL = 'https://shironet.mako.co.il/artist?type=lyrics&lang=1&prfid=1&wrkid=1'
+    HTML = '<html><h1 class="artist_song_name_txt">Title</h1><span itemprop="Lyrics">La la</span></html>'
+
+    def setUp(self):
+        get_redis().delete(ShironetParser._page_key(self.URL))
+        self.parser = ShironetParser()
+        self.lock = MagicMock()
+
+    @staticmethod
+    def _response(status_code, text='', headers=None):
+        return MagicMock(status_code=status_code, text=text, headers=headers or {})
+
+    def _fetch(self, response):
+        """The (title, lyrics) fetched from the page"""
+        with patch.object(ShironetParser, 'get_url', return_value=response) as get_url, \
+                patch('song_signup.tasks.sherlock.Lock', return_value=self.lock):
+            lyrics = [(result.title, result.lyrics)
+                      for result in self.parser.get_lyrics('Song', 'Musical', urls=[self.URL])]
+        return lyrics, get_url
+
+    def test_fresh(self):
+        lyrics, get_url = self._fetch(self._response(200, self.HTML, {'ETag': '"v1"'}))
+        self.assertEqual(lyrics, [('Title', 'La la')])
+        get_url.assert_called_once_with(self.URL, {})
+
+        self.lock.reset_mock()
+        lyrics, get_url = self._fetch(self._response(500))
+        self.assertEqual(lyrics, [('Title', 'La la')])
+        get_url.assert_not_called()
+        self.lock.acquire.assert_not_called()
+
+    def test_page_not_kept(self):
+        self._fetch(self._response(200, self.HTML))
+        self.assertEqual(set(self.parser.cached_page(self.URL)),
+                         {'fetched_at', 'etag', 'last_modified', 'title', 'artist', 'lyrics'})
+
+    @override_settings(PAGE_CACHE_FRESH=0)
+    def test_revalidated(self):
+        self._fetch(self._response(200, self.HTML, {'ETag': '"v1"', 'Last-Modified': 'Sat, 17 Oct 2026 10:00:00 GMT'}))
+
+        lyrics, get_url = self._fetch(self._response(304))
+        self.assertEqual(lyrics, [('Title', 'La la')])
+        get_url.assert_called_once_with(self.URL, {'If-None-Match': '"v1"',
+                                                   'If-Modified-Since': 'Sat, 17 Oct 2026 10:00:00 GMT'})
+
+        # Still revalidated with the same validators after a 304 without them
+        new_html = self.HTML.replace('La la', 'New')
+        lyrics, get_url = self._fetch(self._response(200, new_html, {'ETag': '"v2"'}))
+        self.assertEqual(lyrics, [('Title', 'New')])
+        self.assertEqual(get_url.call_args.args[1]['If-None-Match'], '"v1"')
+
+    def test_errors_not_cached(self):
+        self.assertEqual(self._fetch(self._response(404))[0], [])
+        self.assertEqual(self._fetch(self._response(304))[0], [])  # Nothing to revalidate
+        self.assertEqual(self._fetch(self._response(200, self.HTML))[0], [('Title', 'La la')])
+
+    @override_settings(PAGE_CACHE_FRESH=0)
+    def test_unparsable_page_forgotten(self):
+        self._fetch(self._response(200, self.HTML))
+        self.assertEqual(self._fetch(self._response(200, '<html></html>'))[0], [])
+        self.assertFalse(get_redis().exists(ShironetParser._page_key(self.URL)))
+
+        lyrics, get_url = self._fetch(self._response(200, self.HTML))
+        self.assertEqual(lyrics, [('Title', 'La la')])
+        get_url.assert_called_once_with(self.URL, {})
+
+
+class TestFetchLyrics(TransactionTestCase):
+    def setUp(self):
+        create_singers(1)
+        self.song = SongRequest.objects.create(song_name='Defying Gravity', musical='Wicked', singer=get_singer(1))
+
+    def test_concurrent(self):
+        running = {}
+        max_running = {}
+        lock = threading.Lock()
+
+        def get_lyrics(parser, song_name, author, urls):
+            with lock:
+                running[parser.SITE] = running.get(parser.SITE, 0) + 1
+                max_running[parser.SITE] = max(max_running.get(parser.SITE, 0), running[parser.SITE])
+                max_running['all'] = max(max_running.get('all', 0), sum(running.values()))
+            time.sleep(0.05)
+            with lock:
+                running[parser.SITE] -= 1
+            if isinstance(parser, ShironetParser):
+                raise Exception("Broken provider")
+            return [LyricsResult(lyrics=f'{type(parser).__name__} lyrics', title=song_name, artist=author,
+                                 url=f'https://{parser.SITE}/{url}') for url in urls or ['api']]
+
+        providers = {parser_name: (parser.SITE, ['a', 'b', 'c', 'd'] if parser.SEARCHED else None)
+                     for parser_name, parser in PARSERS.items()}
+        with patch('song_signup.tasks.lyrics_providers', return_value=providers), \
+                patch.object(LyricsWebsiteParser, 'get_lyrics', get_lyrics), \
+                patch.object(GeniusApiParser, 'get_lyrics', get_lyrics), \
+                self.assertLogs('song_signup.lyrics_engine', level='ERROR'):
+            fetch_lyrics(self.song.id, None)
+
+        lyrics = SongLyrics.objects.filter(song_request=self.song)
+        self.assertEqual(lyrics.count(), 3 * (len(PARSERS) - 2) + 1)  # 3 per site, the API's one, the broken none
+        self.assertEqual(LibraryLyrics.objects.count(), lyrics.count())
+        self.assertGreater(max_running['all'], 1)
+        self.assertEqual(max_running['genius.com'], 1)  # The two Genius providers took turns
@@ -1,8 +1,16 @@
+from django.db import connection, transaction
+from django.test import TransactionTestCase, override_settings
+from flags.state import enable_flag
 from freezegun import freeze_time
+from mock import patch
+
+from song_signup.managers import LINEUP_LOCK, RECALC_PENDING_KEY
 from song_signup.models import SongRequest, Singer
+from song_signup.tasks import recalculate_positions
 from song_signup.tests.utils_for_tests import (
     SongRequestTestCase, create_singers, add_songs_to_singers, TEST_START_TIME
 )
+from twist.utils import get_redis
 
 class TestSongRequestManager(SongRequestTestCase):
     def test_spotlight(self):
@@ -79,3 +87,93 @@ class TestSongRequestManager(SongRequestTestCase):
             self.assertFalse(song3.spotlight)
             self.assertEqual(song3.performance_time, TEST_START_TIME)
             self.assertIsNone(song3.position)
+
+
+@override_settings(LINEUP_RECALC_DEBOUNCE=0.5)
+@patch('song_signup.tasks.recalculate_positions.apply_async')
+class TestDebouncedRecalculation(TransactionTestCase):
+    def setUp(self):
+        enable_flag('CAN_SIGNUP')
+        get_redis().delete(RECALC_PENDING_KEY)
+
+    def _sign_up(self, singers):
+        for singer in singers:
+            SongRequest.objects.create(song_name=f"song_{singer.pk}", musical="Wicked", singer=singer)
+            Singer.ordering.request_recalculation()
+
+    def test_burst_is_coalesced(self, apply_async):
+        singers = create_singers(5)
+        self._sign_up(singers)
+
+        apply_async.assert_called_once_with(countdown=0.5)
+        self.assertFalse(SongRequest.objects.filter(position__isnull=False).exists())
+
+        recalculate_positions()
+        self.assertEqual([song.singer for song in SongRequest.objects.filter(position__isnull=False)], singers)
+
+    def test_change_after_recalculation_schedules_another(self, apply_async):
+        singers = create_singers(2)
+        self._sign_up(singers[:1])
+        recalculate_positions()
+
+        self._sign_up(singers[1:])
+        self.assertEqual(apply_async.call_count, 2)
+
+        recalculate_positions()
+        self.assertEqual(SongRequest.objects.filter(position__isnull=False).count(), 2)
+
+    def test_rolled_back_change_not_marked(self, apply_async):
+        singers = create_singers(2)
+        with transaction.atomic():
+            self._sign_up(singers[:1])
+            transaction.set_rollback(True)
+
+        apply_async.assert_not_called()
+        self._sign_up(singers[1:])
+        apply_async.assert_called_once_with(countdown=0.5)
+
+    @override_settings(LINEUP_RECALC_DEBOUNCE=0)
+    def test_no_debounce_recalculates_inline(self, apply_async):
+        self._sign_up(create_singers(2))
+
+        apply_async.assert_not_called()
+        self.assertEqual(SongRequest.objects.filter(position__isnull=False).count(), 2)
+
+
+class TestLineupLock(TransactionTestCase):
+    def setUp(self):
+        enable_flag('CAN_SIGNUP')
+        self.other_connection = connection.copy()
+        self.addCleanup(self.other_connection.close)
+
+    def _other_connection_query(self, sql, params=None):
+        with self.other_connection.cursor() as cursor:
+            cursor.execute("SET lock_timeout = '1s'")
+            cursor.execute(sql, params)
+            return cursor.fetchone() if cursor.description else None
+
+    def test_lock_only_blocks_recalculations(self):
+        create_singers(2)
+        [song1, _] = add_songs_to_singers(2, 1)
+        observed = {}
+
+        def ordering_while_locked():
+            # Runs inside the recalculation, while it holds the lock
+            observed['lock_free'] = self._other_connection_query("SELECT pg_try_advisory_lock(hashtext(%s))",
+                                                                 [LINEUP_LOCK])[0]
+            self._other_connection_query("UPDATE song_signup_songrequest SET song_name = 'updated' WHERE id = %s",
+                                         [song1.pk])
+            return list(Singer.ordering.active_singers_queryset().order_by('pk'))
+
+        with patch.object(Singer.ordering, 'singer_disneyland_ordering', side_effect=ordering_while_locked):
+            Singer.ordering.calculate_positions()
+
+        self.assertFalse(observed['lock_free'])
+        song1.refresh_from_db()
+        self.assertEqual(song1.song_name, 'updated')
+
+    def test_contention_metrics_are_logged(self):
+        with self.assertLogs('twist.utils', level='INFO') as logs:
+            Singer.ordering.calculate_positions()
+
+        self.assertRegex(logs.output[0], rf"Advisory lock {LINEUP_LOCK}: waited [\d.]+ms, held [\d.]+ms")
@@ -8,7 +8,7 @@ from song_signup.tests.utils_for_tests import (
     get_singer_str, create_audience, get_audience_str, EVENT_SKU
 )
 from peoples_choice.models import SongSuggestion
-from song_signup.models import TicketsDepleted, Singer, SongRequest, _normalize_string, _fuzzy_match, _check_peoples_choice_match
+from song_signup.models import TicketsDepleted, Singer, SongRequest, SongLyrics, _normalize_string, _fuzzy_match, _check_peoples_choice_match
 from django.core.management import call_command
 
 
@@ -588,3 +588,29 @@ class TestSongRequestPeoplesChoice(SongRequestTestCase):
 
 
 
+
+
+class TestSongLyricsRank(SongRequestTestCase):
+    def _add_lyrics(self, song, title, default=False):
+        return SongLyrics.objects.create(song_name=title, artist_name='Artist', lyrics='La la la', song_request=song,
+                                         default=default)
+
+    def test_rank(self):
+        create_singers(1)
+        [song] = add_songs_to_singer(1, 1)
+        song.song_name = 'Defying Gravity'
+        song.save()
+
+        other = self._add_lyrics(song, 'Popular')
+        right = self._add_lyrics(song, 'Gravity')
+        left = self._add_lyrics(song, 'Defying Gravity (Reprise)')
+        exact = self._add_lyrics(song, 'defying gravity')
+
+        self.assertEqual([other.rank, right.rank, left.rank, exact.rank],
+                         [SongLyrics.NO_MATCH, SongLyrics.RIGHT_MATCH, SongLyrics.LEFT_MATCH, SongLyrics.EXACT_MATCH])
+        self.assertEqual(list(song.lyrics.order_by(*SongLyrics.BEST_FIRST)), [exact, left, right, other])
+
+        # The chosen lyrics come first, whatever their rank
+        other.default = True
+        other.save()
+        self.assertEqual(song.lyrics.order_by(*SongLyrics.BEST_FIRST).first(), other)
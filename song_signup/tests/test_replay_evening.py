@@ -0,0 +1,82 @@
+import csv
+import os
+import tempfile
+import time
+from io import StringIO
+
+from constance import config
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+
+from song_signup.management.commands.replay_evening import (
+    build_stream, LOGIN, SIGNUP, PERFORM, GROUP_SONG_SLOT, REPLAY_PASSCODE
+)
+from song_signup.models import Singer, SongRequest
+
+SETLIST = [
+    ['Group Song', 'Gaston', 'Beauty and the Beast'],
+    ['Tal Frisch', 'Its a Privilege to Pee', 'Urinetown'],
+    ['Yoni Linder and Tal Frisch', 'Dead Gay Son', 'Heathers'],
+    ['Tal Frisch', 'Pulled', 'The Addams Family'],
+]
+
+
+class TestReplayEvening(TestCase):
+    def test_build_stream(self):
+        tal_first = ('Tal Frisch', [], 'Its a Privilege to Pee', 'Urinetown')
+        yoni = ('Yoni Linder', ['Tal Frisch'], 'Dead Gay Son', 'Heathers')
+        tal_second = ('Tal Frisch', [], 'Pulled', 'The Addams Family')
+
+        self.assertEqual(build_stream(SETLIST, lead=1), [
+            (-0.5, LOGIN, 'Tal Frisch'),
+            (-0.5, SIGNUP, tal_first),
+            (0, GROUP_SONG_SLOT, ('Gaston', 'Beauty and the Beast')),
+            (0.5, LOGIN, 'Yoni Linder'),
+            (0.5, SIGNUP, yoni),
+            (1, PERFORM, tal_first),
+            (1.5, SIGNUP, tal_second),  # Signs up again right after performing
+            (2, PERFORM, yoni),
+            (3, PERFORM, tal_second),
+        ])
+
+
+class TestReplay(TransactionTestCase):
+    def _replay(self, *args):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            setlist = os.path.join(tmp_dir, 'bwt-test.csv')
+            output = os.path.join(tmp_dir, 'results.csv')
+            with open(setlist, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['', 'Singers', 'Song', 'Musical'])
+                writer.writerows([i, *row] for i, row in enumerate(SETLIST, start=1))
+
+            call_command('replay_evening', setlist, '--output', output, *args, stdout=StringIO())
+
+            with open(output, newline='') as f:
+                return list(csv.DictReader(f))
+
+    def test_replay(self):
+        results = self._replay('--speed', '0', '--debounce', '0')
+
+        operations = [result['operation'] for result in results]
+        self.assertEqual(operations.count('login'), 2)
+        self.assertEqual(operations.count('add_song_request'), 3)
+        self.assertEqual(operations.count('set_performed'), 3)
+        self.assertEqual(operations.count('start_group_song'), 1)
+        self.assertNotIn('stage_state', operations)  # No time to poll in
+        self.assertTrue(all(result['status'] in ('200', '302') for result in results))
+
+        # The evening was replayed on a scratch database and Redis
+        self.assertFalse(Singer.objects.exists())
+        self.assertFalse(SongRequest.objects.exists())
+        self.assertNotEqual(config.PASSCODE, REPLAY_PASSCODE)
+
+    def test_timed_replay(self):
+        started = time.monotonic()
+        results = self._replay('--slot-seconds', '0.2', '--speed', '1', '--debounce', '0.05')
+
+        self.assertGreaterEqual(time.monotonic() - started, 3.5 * 0.2)  # From the first login to the last song
+        operations = [result['operation'] for result in results]
+        self.assertIn('stage_state', operations)
+        self.assertIn('recalculate_positions', operations)  # Debounced, off the requests
+        self.assertFalse(SongRequest.objects.exists())
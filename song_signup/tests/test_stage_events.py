@@ -0,0 +1,97 @@
+import asyncio
+
+from django.db import connection
+from django.test import TransactionTestCase
+
+from song_signup.stage import stage_version
+from song_signup.stage_events import StageEvents
+from song_signup.tests.utils_for_tests import create_singers, add_songs_to_singer
+
+SCOPE = {'type': 'http', 'path': '/stage_events', 'method': 'GET', 'headers': []}
+
+
+async def wait_until(condition, timeout=5):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+class TestStageEvents(TransactionTestCase):
+    def _stream(self, change_stage):
+        """Connect a client, change the stage while it's connected, and return the events it got"""
+        async def run():
+            app = StageEvents()
+            sent = []
+            disconnect = asyncio.Event()
+
+            async def receive():
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+
+            def events():
+                return [message['body'].decode() for message in sent[1:]]
+
+            client = asyncio.ensure_future(app(SCOPE, receive, send))
+            await wait_until(lambda: len(events()) == 2)  # The retry interval, and the current version
+
+            await asyncio.get_running_loop().run_in_executor(None, self._in_thread, change_stage)
+            final_event = f'event: stage\ndata: {stage_version()}\n\n'
+            await wait_until(lambda: events()[-1] == final_event)
+
+            disconnect.set()
+            await asyncio.wait_for(client, 5)
+            app.listener.cancel()
+            return sent[0], events()
+
+        return asyncio.run(run())
+
+    @staticmethod
+    def _in_thread(func):
+        """The ORM can't run in the event loop - run it in a thread, as the views would be"""
+        try:
+            func()
+        finally:
+            connection.close()
+
+    def test_stream(self):
+        create_singers(1)
+        version = stage_version()
+
+        start, events = self._stream(lambda: add_songs_to_singer(1, 1))
+
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), start['headers'])
+        self.assertGreater(stage_version(), version)
+        self.assertEqual(events[:2], ['retry: 3000\n\n', f'event: stage\ndata: {version}\n\n'])
+        self.assertEqual(events[-1], f'event: stage\ndata: {stage_version()}\n\n')
+
+    def test_change_while_sending(self):
+        async def run():
+            app = StageEvents()
+            app.changed = asyncio.Event()
+            app.listener = asyncio.get_running_loop().create_future()  # Versions are set by the test, not Redis
+            app.set_version(1)
+            sent = []
+            disconnect = asyncio.Event()
+
+            async def receive():
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message.get('body', b'').decode())
+                if sent[-1] == 'event: stage\ndata: 1\n\n':
+                    app.set_version(2)  # Changed while the previous version is being sent
+
+            client = asyncio.ensure_future(app(SCOPE, receive, send))
+            # Well before the keepalive would have woken the stream up
+            await wait_until(lambda: sent[-1] == 'event: stage\ndata: 2\n\n', timeout=1)
+            disconnect.set()
+            await asyncio.wait_for(client, 5)
+
+        asyncio.run(run())
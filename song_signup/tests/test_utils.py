@@ -1,5 +1,10 @@
-from django.test import TestCase
-from twist.utils import format_commas
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from flags.models import FlagState
+from flags.state import disable_flag, enable_flag, flag_enabled
+
+from twist.flag_sources import FLAGS_VERSION_KEY
+from twist.utils import format_commas, get_redis
 
 class TestFormatCommas(TestCase):
     def test_4_singers(self):
@@ -31,3 +36,37 @@ class TestFormatCommas(TestCase):
         expected_res = ""
 
         self.assertEqual(format_commas(singers), expected_res)
+
+
+class TestCachedFlags(TransactionTestCase):
+    def test_cached_until_changed(self):
+        enable_flag('STARTED')
+        self.assertTrue(flag_enabled('STARTED'))
+
+        with self.assertNumQueries(0):
+            self.assertTrue(flag_enabled('STARTED'))
+            self.assertFalse(flag_enabled('BOHO'))
+
+        disable_flag('STARTED')
+        self.assertFalse(flag_enabled('STARTED'))
+
+    def test_changed_by_another_process(self):
+        disable_flag('STARTED')
+        self.assertFalse(flag_enabled('STARTED'))
+
+        FlagState.objects.filter(name='STARTED').update(value='True')
+        self.assertFalse(flag_enabled('STARTED'))
+
+        # The other process bumps the version once its change is committed
+        get_redis().incr(FLAGS_VERSION_KEY)
+        self.assertTrue(flag_enabled('STARTED'))
+
+    def test_not_cached_inside_transaction(self):
+        self.assertFalse(flag_enabled('STARTED'))
+
+        with transaction.atomic():
+            enable_flag('STARTED')
+            self.assertTrue(flag_enabled('STARTED'))
+            transaction.set_rollback(True)
+
+        self.assertFalse(flag_enabled('STARTED'))
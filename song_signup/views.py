@@ -17,6 +17,7 @@ from django.http import JsonResponse, HttpResponse, HttpResponseRedirect
 from django.shortcuts import render, redirect
 from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.vary import vary_on_headers
 from flags.state import enable_flag, disable_flag, flag_disabled, flag_enabled
 from openpyxl import load_workbook
 from rest_framework import status
@@ -26,6 +27,9 @@ from rest_framework.response import Response
 from titlecase import titlecase
 from django.core.exceptions import ValidationError
 from .forms import TickchakUploadForm
+from .lyrics_payload import accepted_encoding, lyrics_response
+from .polling import polled
+from .stage import bump_stage_version, lyrics_version, polled_etag, stage_etag, stage_snapshot
 from .tasks import get_lyrics
 from .models import (
     GroupSongRequest,
@@ -39,9 +43,12 @@ from .models import (
     TicketsDepleted,
     AlreadyLoggedIn,
     CurrentGroupSong,
+    current_song_key,
+    get_current_song,
     TriviaQuestion,
     TriviaResponse,
-    Celebration
+    Celebration,
+    LineupSnapshot,
 )
 from .serializers import (
     SongSuggestionSerializer,
@@ -106,7 +113,7 @@ def home(request):
     })
 
 
-def spotlight_data(request):
+def _spotlight_data():
     current_song, is_group_song = _get_current_song()
 
     if is_group_song:
@@ -114,31 +121,93 @@ def spotlight_data(request):
     else:
         next_song = SongRequest.objects.next_song()
 
-    return JsonResponse(
-        {
-            "current_song": current_song and current_song.basic_data,
-            "next_song": next_song and next_song.basic_data,
-        })
+    return {
+        "current_song": current_song and current_song.basic_data,
+        "next_song": next_song and next_song.basic_data,
+    }
+
+
+@stage_etag()
+def spotlight_data(request):
+    return JsonResponse(_shared_state()['spotlight'])
 
 
+def _next_singer():
+    next_song = SongRequest.objects.current_song()
+    return next_song.singer.username if next_song is not None else None
+
+
+@stage_etag()
 def next_singer(request):
     """
     Return username of next singer
     """
-    next_song = SongRequest.objects.current_song()
-    username = next_song.singer.username if next_song is not None else None
-
     return JsonResponse({
-        "next_singer": username
+        "next_singer": _shared_state()['next_singer']
     })
 
 
+def _dashboard_data(singer):
+    # Maintained by the lineup recalculation, so a single lookup is enough
+    snapshot = LineupSnapshot.objects.select_related('song__singer').filter(singer=singer).first()
+
+    return {"user_next_song": snapshot and snapshot.basic_data,
+            "raffle_winner_already_sang": singer.raffle_winner_already_sang}
+
+
+@stage_etag(per_user=True)
 def dashboard_data(request):
-    singer = request.user
-    user_next_song = singer.next_song
+    return JsonResponse(_dashboard_data(request.user))
+
+
+def _build_shared_state():
+    return {
+        "started": flag_enabled('STARTED'),
+        "boho": flag_enabled('BOHO'),
+        "can_signup": flag_enabled('CAN_SIGNUP'),
+        "next_singer": _next_singer(),
+        "spotlight": _spotlight_data(),
+        "lineup": _lineup(),
+        "active_question": _active_question(),
+        "current_song": current_song_key(*_get_current_song()),
+        # Shuffled once per version, so that every screen shows the same draw
+        "raffle_participants": _raffle_participants(),
+    }
+
+
+def _shared_state():
+    """The state that's the same for every user, read from the stage snapshot in Redis"""
+    return stage_snapshot(_build_shared_state)
+
 
-    return JsonResponse({"user_next_song": user_next_song and user_next_song.basic_data,
-                         "raffle_winner_already_sang": singer.raffle_winner_already_sang})
+@polled
+@stage_etag(per_user=True)
+def stage_state(request):
+    """
+    Everything the polling pages need, in a single response instead of a request per piece of data.
+    The lyrics screen adds `live_lyrics=true` for the raffle - it fetches the (much larger) lyrics, with the drinking
+    words already highlighted, from /current_lyrics, only when the lyrics version changes.
+    The version changes whenever any of the data changes.
+    """
+    shared = _shared_state()
+    user = request.user
+
+    state = {
+        "version": shared['version'],
+        "started": shared['started'],
+        "boho": shared['boho'],
+        "can_signup": shared['can_signup'],
+        "next_singer": shared['next_singer'],
+        "spotlight": shared['spotlight'],
+        "active_question": shared['active_question'],
+        "dashboard": _dashboard_data(user) if user.is_authenticated and user.is_singer else None,
+    }
+
+    if request.GET.get('live_lyrics') == 'true':
+        state["raffle_participants"] = shared['raffle_participants']
+        state["lyrics_version"] = _current_lyrics_version()
+
+    return JsonResponse(state)
 
 
 def _sanitize_string(name, title=False):
@@ -169,7 +238,7 @@ def add_song_request(request):
                 except ValidationError as e:
                     return JsonResponse({"error": e.message}, status=400)
 
-            Singer.ordering.calculate_positions()
+            Singer.ordering.request_recalculation()
             return JsonResponse({
                 'requested_song': new_song_request.song_name,
             })
@@ -191,6 +260,7 @@ def get_current_songs(request):
     return Response(serialized.data, status=status.HTTP_200_OK)
 
 
+@stage_etag()
 @api_view(["GET"])
 def get_suggested_songs(request):
     serialized = SongSuggestionSerializer(SongSuggestion.objects.all().order_by('is_used', '-request_time'),
@@ -204,11 +274,15 @@ def get_current_user(request):
     return Response(serialized.data, status=status.HTTP_200_OK)
 
 
+def _drinking_words():
+    drinking_words = constance.config.DRINKING_WORDS
+    return drinking_words.split(';') if drinking_words else []
+
+
+@stage_etag()
 @api_view(["GET"])
 def get_drinking_words(request):
-    drinking_words = constance.config.DRINKING_WORDS
-    return Response({'drinking_words': drinking_words.split(';') if drinking_words else []},
-                    status=status.HTTP_200_OK)
+    return Response({'drinking_words': _drinking_words()}, status=status.HTTP_200_OK)
 
 
 @api_view(["GET"])
@@ -228,8 +302,7 @@ def get_song(request, song_pk):
         return Response({'error': f"Song with ID {song_pk} does not exist"}, status=status.HTTP_400_BAD_REQUEST)
 
 
-@api_view(["GET"])
-def get_lineup(request):
+def _lineup():
     song_requests = SongRequest.objects.filter(position__isnull=False, skipped=False).order_by('position')
     current_song, is_group_song = _get_current_song()
 
@@ -240,10 +313,16 @@ def get_lineup(request):
         current_song_data = SongRequestLineupSerializer(current_song).data
         next_songs_data = SongRequestLineupSerializer(song_requests[1:], many=True).data
 
-    return Response({
+    return {
         'current_song': current_song_data,
         'next_songs': next_songs_data
-    }, status=status.HTTP_200_OK)
+    }
+
+
+@stage_etag()
+@api_view(["GET"])
+def get_lineup(request):
+    return Response(_shared_state()['lineup'], status=status.HTTP_200_OK)
 
 
 @api_view(["PUT"])
@@ -272,6 +351,7 @@ def update_song(request):
         song_request.notes = notes
         song_request.partners.set(partners)
         song_request.save()
+        Singer.ordering.refresh_snapshots()  # The partners' next songs might have changed
 
         serialized = SongRequestSerializer(song_request, read_only=True)
         return Response(serialized.data, status=status.HTTP_200_OK)
@@ -312,36 +392,11 @@ def get_possible_partners(request):
 
 
 def _sort_lyrics(song: SongRequest | GroupSongRequest):
-    """
-    Sort the lyrics based on our best guess of how well they match
-    Tried a few algorithms here but this relatively simple one worked best:
-
-    1) If default is selected order first
-    2) Songs with exact name matches
-    3) Songs with left matches (input song name is included in full song name)
-    4) Songs with right matches (full song name is included in input song name)
-    5) Everything else
-
-    Within each group just order by ID for consistency.
-    """
+    """Sort the lyrics based on our best guess of how well they match (see lyrics_rank)"""
     if not song:
         return
 
-    lyrics = song.lyrics.order_by('id').all()
-
-    default = [lyric for lyric in lyrics if lyric.default]
-    lyrics = [lyric for lyric in lyrics if lyric not in default]
-
-    exact_matches = [lyric for lyric in lyrics if song.song_name.lower() == lyric.song_name.lower()]
-    lyrics = [lyric for lyric in lyrics if lyric not in exact_matches]
-
-    left_matches = [lyric for lyric in lyrics if song.song_name.lower() in lyric.song_name.lower()]
-    lyrics = [lyric for lyric in lyrics if lyric not in left_matches]
-
-    right_matches = [lyric for lyric in lyrics if lyric.song_name.lower() in song.song_name.lower()]
-    lyrics = [lyric for lyric in lyrics if lyric not in right_matches]
-
-    return default + exact_matches + left_matches + right_matches + lyrics
+    return list(song.lyrics.order_by(*SongLyrics.BEST_FIRST))
 
 
 @superuser_required('login')
@@ -369,13 +424,13 @@ def group_lyrics(request, song_pk):
 
 @superuser_required('login')
 def force_reset_lyrics(request, song_pk):
-    get_lyrics.delay(song_id=song_pk)
+    get_lyrics.delay(song_id=song_pk, refresh=True)
     time.sleep(1)
     return redirect('alternative_lyrics', song_pk)
 
 @superuser_required('login')
 def force_reset_lyrics_group(request, song_pk):
-    get_lyrics.delay(group_song_id=song_pk)
+    get_lyrics.delay(group_song_id=song_pk, refresh=True)
     time.sleep(1)
     return redirect('alternative_group_lyrics', song_pk)
 
@@ -445,19 +500,29 @@ def _get_current_song():
     """
     Return current_song, is_group_song
     """
-    curr_group_song = CurrentGroupSong.objects.all().first()
-    if curr_group_song and curr_group_song.is_active:
-        return curr_group_song.group_song, True
-    else:
-        return SongRequest.objects.get_spotlight() or SongRequest.objects.current_song(), False
+    return get_current_song()
+
+
+def _current_lyrics_version(request=None, *args, **kwargs):
+    """Changes with the current song, and whenever its lyrics (or the drinking words) change"""
+    return f"{lyrics_version()}-{_shared_state()['current_song']}"
+
+
+def _current_lyrics_etag(request, *args, **kwargs):
+    # Each encoding of the lyrics is a different body - never revalidate one with another's ETag
+    return f"{_current_lyrics_version()}-{accepted_encoding(request)}"
 
 
+@vary_on_headers('Accept-Encoding')  # The 304s too, not only the lyrics responses
+@polled_etag(_current_lyrics_etag)
 @api_view(["GET"])
 def get_current_lyrics(request):
     current, is_group_song = _get_current_song()
-    lyrics = _sort_lyrics(current)
-    serialized = LyricsSerializer(lyrics[0] if lyrics else None, many=False, read_only=True,
-                                  context={'is_group_song': is_group_song})
+    lyrics = current and current.lyrics.order_by(*SongLyrics.BEST_FIRST).first()
+    if lyrics:
+        return lyrics_response(request, lyrics, is_group_song, _drinking_words())
+
+    serialized = LyricsSerializer(lyrics, many=False, read_only=True, context={'is_group_song': is_group_song})
     return Response(serialized.data, status=status.HTTP_200_OK)
 
 
@@ -473,14 +538,15 @@ def demo_current_lyrics(request):
     return Response(serialized.data, status=status.HTTP_200_OK)
 
 
+def _active_question():
+    active_question = TriviaQuestion.objects.filter(is_active=True).first()
+    return TriviaQuestionSerializer(active_question).data if active_question else {}
+
+
+@stage_etag()
 @api_view(["GET"])
 def get_active_question(request):
-    active_question = TriviaQuestion.objects.filter(is_active=True).first()
-    if active_question:
-        serialized = TriviaQuestionSerializer(active_question)
-        return Response(serialized.data, status=status.HTTP_200_OK)
-    else:
-        return Response({}, status=status.HTTP_200_OK)
+    return Response(_shared_state()['active_question'], status=status.HTTP_200_OK)
 
 
 @api_view(["POST"])
@@ -517,6 +583,7 @@ def get_selected_answer(request):
 @superuser_required('login')
 def deactivate_trivia(request):
     TriviaQuestion.objects.all().update(is_active=False)
+    bump_stage_version()  # A bulk update doesn't send the signal that bumps it
     return redirect('admin/song_signup/triviaquestion')
 
 
@@ -586,6 +653,7 @@ def toggle_raffle_participation(request):
     user.save()
     return redirect('home')
 
+@stage_etag()
 @api_view(["GET"])
 def get_active_raffle_winner(request):
     active_winner = Singer.objects.filter(active_raffle_winner=True).first()
@@ -596,8 +664,7 @@ def get_active_raffle_winner(request):
         return Response({}, status=status.HTTP_200_OK)
 
 
-@api_view(["GET"])
-def get_raffle_participants(request):
+def _raffle_participants():
     """
     Return all active raffle participants and mark the current active winner.
     Only returns a list if there's an active winner (prevents race conditions).
@@ -606,7 +673,7 @@ def get_raffle_participants(request):
     active_winner = Singer.objects.filter(active_raffle_winner=True).first()
 
     if not active_winner:
-        return Response({"participants": []}, status=status.HTTP_200_OK)
+        return []
     
     participants = list(Singer.ordering.active_raffle_participants())
     
@@ -624,12 +691,14 @@ def get_raffle_participants(request):
         if participant["id"] == active_winner.id:
             participants_data[i]["is_winner"] = False
             break
-    
-    data = {
-        "participants": participants_data
-    }
 
-    return Response(data, status=status.HTTP_200_OK)
+    return participants_data
+
+
+@stage_etag()
+@api_view(["GET"])
+def get_raffle_participants(request):
+    return Response({"participants": _shared_state()['raffle_participants']}, status=status.HTTP_200_OK)
 
 @bwt_login_required('login')
 def suggest_group_song(request):
@@ -655,7 +724,7 @@ def logout(request):
 
     user.save()
     auth_logout(request)
-    Singer.ordering.calculate_positions()
+    Singer.ordering.request_recalculation()
     return redirect('login')
 
 
@@ -717,7 +786,7 @@ def _login_existing_singer(first_name, last_name, no_image_upload, uploaded_imag
         if uploaded_image:
             singer.selfie = uploaded_image
         singer.save()
-        Singer.ordering.calculate_positions()
+        Singer.ordering.request_recalculation()
         return singer
     except Singer.DoesNotExist:
         raise TwistApiException("The name that you logged in with previously does not match your current one")
@@ -754,6 +823,9 @@ def  _login_existing_audience(first_name, last_name, no_image_upload, uploaded_i
         raise TwistApiException("The name that you logged in with previously does not match your current one")
 
 
+LOGIN_BACKEND = 'twist.auth_backends.CachedModelBackend'  # There's more than one - see AUTHENTICATION_BACKENDS
+
+
 def login(request):
     # This is the root endpoint. If already logged in, go straight to home.
     constants_chosen = bool(config.PASSCODE) and bool(config.EVENT_SKU)
@@ -780,13 +852,13 @@ def login(request):
             if ticket_type == 'audience':
                 audience = _login_existing_audience(first_name, last_name, no_image_upload, uploaded_image) if logged_in else (
                     _login_new_audience(first_name, last_name, no_image_upload, order_id, uploaded_image))
-                auth_login(request, audience)
+                auth_login(request, audience, backend=LOGIN_BACKEND)
                 return JsonResponse({'success': True}, status=200)
 
             elif ticket_type == 'singer':
                 singer = _login_existing_singer(first_name, last_name, no_image_upload, uploaded_image) if logged_in else (
                     _login_new_singer(first_name, last_name, no_image_upload, order_id, uploaded_image))
-                auth_login(request, singer)
+                auth_login(request, singer, backend=LOGIN_BACKEND)
                 return JsonResponse({'success': True}, status=200)
             else:
                 raise TwistApiException("Invalid ticket type")
@@ -805,7 +877,7 @@ def login(request):
 @bwt_login_required('login', singer_only=True)
 def delete_song(request, song_pk):
     SongRequest.objects.filter(pk=song_pk).delete()
-    Singer.ordering.calculate_positions()
+    Singer.ordering.request_recalculation()
     return HttpResponse()
 
 def _get_current_filename():
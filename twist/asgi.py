@@ -13,4 +13,16 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'twist.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from song_signup.stage_events import StageEvents  # noqa: E402 - needs the apps loaded by get_asgi_application
+
+stage_events = StageEvents()
+
+
+async def application(scope, receive, send):
+    """Django, plus the stage events stream - which Django 3.1 can't serve without tying up a thread per client"""
+    if scope['type'] == 'http' and scope['path'] == '/stage_events':
+        await stage_events(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -0,0 +1,66 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from twist.utils import get_redis
+
+USER_CACHE_TIMEOUT = 60 * 60  # Seconds. Only a safety net - the copy is dropped whenever the user changes
+# What the views and templates read of the logged-in user on every request. Any other field (the password included)
+# isn't cached - it's loaded from the DB if it's ever read
+CACHED_USER_FIELDS = ('id', 'username', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser',
+                      'is_audience', 'no_image_upload', 'placeholder', 'raffle_participant', 'raffle_winner',
+                      'active_raffle_winner', 'ticket_order', 'selfie')
+
+
+def user_cache_key(user_id):
+    return f'user-record:{user_id}'
+
+
+def forget_cached_user(user_id):
+    """Drop the copy of the user now, and again once the transaction commits (a request might have re-read the old row)"""
+    key = user_cache_key(user_id)
+    get_redis().delete(key)
+    transaction.on_commit(lambda: get_redis().delete(key))
+
+
+def _user_record(user):
+    fields = [user._meta.get_field(name) for name in CACHED_USER_FIELDS]
+    return {
+        'fields': {field.attname: field.get_prep_value(field.value_from_object(user)) for field in fields},
+        'session_auth_hash': user.get_session_auth_hash(),
+    }
+
+
+def _user_from_record(record):
+    user_model = get_user_model()
+    fields = record['fields']
+    # Loaded like a queryset with only() - the other fields are deferred, and saving the user only saves these
+    field_names = [field.attname for field in user_model._meta.concrete_fields if field.attname in fields]
+    user = user_model.from_db(DEFAULT_DB_ALIAS, field_names, [fields[field] for field in field_names])
+    user.cached_session_auth_hash = record['session_auth_hash']
+    return user
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend, loading the logged-in user of each request from a record of them in Redis instead of the DB.
+    The record is JSON of the fields the requests read (see CACHED_USER_FIELDS) and the session auth hash - never the
+    password, and nothing that runs code when it's loaded.
+    """
+
+    def get_user(self, user_id):
+        redis = get_redis()
+        key = user_cache_key(user_id)
+
+        cached = redis.get(key)
+        if cached is not None:
+            user = _user_from_record(json.loads(cached))
+        else:
+            user = super().get_user(user_id)
+            # Inside a transaction we may be seeing changes that will never be committed - don't share them
+            if user is not None and not transaction.get_connection().in_atomic_block:
+                redis.set(key, json.dumps(_user_record(user)), ex=USER_CACHE_TIMEOUT)
+
+        return user if user is not None and self.user_can_authenticate(user) else None
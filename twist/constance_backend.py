@@ -0,0 +1,44 @@
+import threading
+
+from constance import settings
+from constance.backends.redisd import RedisBackend
+
+
+class SnapshotRedisBackend(RedisBackend):
+    """
+    Constance's Redis backend, reading all the config with a single MGET per request instead of a GET per attribute
+    access (see ConfigSnapshotMiddleware).
+    Outside a request (celery, the shell) every access still goes to Redis, so long-running processes never hold on
+    to stale values.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._local = threading.local()
+
+    def start_snapshot(self):
+        self._local.active = True
+        self._local.snapshot = None  # Loaded on first access - a request might not read the config at all
+
+    def end_snapshot(self):
+        self._local.active = False
+        self._local.snapshot = None
+
+    def _get_snapshot(self):
+        if not getattr(self._local, 'active', False):
+            return None
+        if self._local.snapshot is None:
+            self._local.snapshot = dict(self.mget(list(settings.CONFIG)))
+        return self._local.snapshot
+
+    def get(self, key):
+        snapshot = self._get_snapshot()
+        if snapshot is None:
+            return super().get(key)
+        return snapshot.get(key)
+
+    def set(self, key, value):
+        super().set(key, value)
+        snapshot = getattr(self._local, 'snapshot', None)
+        if snapshot is not None:
+            snapshot[key] = value  # Reads later in the request see their own writes
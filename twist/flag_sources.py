@@ -0,0 +1,39 @@
+import threading
+
+from django.db import transaction
+from flags.sources import DatabaseFlagsSource
+
+from twist.utils import get_redis
+
+FLAGS_VERSION_KEY = 'flags:version'
+
+
+def bump_flags_version():
+    """Make every process reload the flags, once the current transaction commits"""
+    transaction.on_commit(lambda: get_redis().incr(FLAGS_VERSION_KEY))
+
+
+class CachedDatabaseFlagsSource(DatabaseFlagsSource):
+    """
+    The flags stored in the DB, cached in process memory for as long as the flags version in Redis doesn't change.
+    A flag check costs a Redis GET instead of a query, and a change is seen by every process on its next check.
+    """
+    _lock = threading.Lock()
+    _version = None
+    _flags = None
+
+    def get_flags(self):
+        if transaction.get_connection().in_atomic_block:
+            # We'd be caching changes of this transaction for everyone, before (or without) them being committed
+            return super().get_flags()
+
+        # Read before loading, so a change committed while loading shows up as a newer version on the next check
+        version = get_redis().get(FLAGS_VERSION_KEY)
+        with self._lock:
+            if self._flags is None or version != self._version:
+                CachedDatabaseFlagsSource._flags = super().get_flags()
+                CachedDatabaseFlagsSource._version = version
+            flags = self._flags
+
+        # get_flags() merges the conditions of all sources into these lists
+        return {name: list(conditions) for name, conditions in flags.items()}
@@ -0,0 +1,55 @@
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+
+from twist.utils import get_redis
+
+KEY_PREFIX = 'session:'
+
+
+class SessionStore(DBStore):
+    """
+    Sessions in the DB, read through a copy in Redis - like Django's cached_db engine, which needs a Redis cache
+    backend that Django only has from 4.0.
+    Sessions only change on login and logout, so a request usually reads its session from Redis alone.
+    """
+    cache_key_prefix = KEY_PREFIX
+
+    @property
+    def cache_key(self):
+        return self.cache_key_prefix + self._get_or_create_session_key()
+
+    def _cache_session(self, session_data, expiry_age):
+        if expiry_age > 0:
+            get_redis().set(self.cache_key, session_data, ex=expiry_age)
+
+    def load(self):
+        session_data = get_redis().get(self.cache_key)
+        if session_data is not None:
+            return self.decode(session_data.decode())
+
+        s = self._get_session_from_db()
+        if not s:
+            return {}
+        self._cache_session(s.session_data, self.get_expiry_age(expiry=s.expire_date))
+        return self.decode(s.session_data)
+
+    def exists(self, session_key):
+        return bool(session_key and get_redis().exists(self.cache_key_prefix + session_key)) or \
+            super().exists(session_key)
+
+    def save(self, must_create=False):
+        super().save(must_create)
+        self._cache_session(self.encode(self._get_session(no_load=must_create)), self.get_expiry_age())
+
+    def delete(self, session_key=None):
+        super().delete(session_key)
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        get_redis().delete(self.cache_key_prefix + session_key)
+
+    def flush(self):
+        """Remove the current session data from the database and regenerate the key"""
+        self.clear()
+        self.delete(self.session_key)
+        self._session_key = None
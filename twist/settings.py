@@ -31,6 +31,12 @@ DEBUG = True
 TEMPLATE_DEBUG = True
 
 SESSION_COOKIE_AGE = 86400  # 24 hours
+SESSION_ENGINE = 'twist.session_store'
+AUTHENTICATION_BACKENDS = [
+    'twist.auth_backends.CachedModelBackend',
+    # Sessions store the backend that logged the user in - sessions from before the cached backend still name this one
+    'django.contrib.auth.backends.ModelBackend',
+]
 
 
 INTERNAL_IPS = [
@@ -47,6 +53,10 @@ FLAGS = {
     'BOHO': [],
     'SHANI_PING': [],
 }
+FLAG_SOURCES = (
+    'flags.sources.SettingsFlagsSource',
+    'twist.flag_sources.CachedDatabaseFlagsSource',
+)
 
 LOGGING = {
     'version': 1,
@@ -119,9 +129,10 @@ CONSTANCE_CONFIG = {
     'PEOPLES_CHOICE_EVENT_DATE': ('', "Event date for People's Choice page (e.g., '23.11.25') - REQUIRED FOR PEOPLE'S CHOICE"),
     'PEOPLES_CHOICE_EVENT_SKU': ('', "Event SKU for People's Choice page - REQUIRED FOR PEOPLE'S CHOICE"),
     'EVENING_TYPE': ('open_mic', "Type of evening: root URL shows this page", 'EVENING_TYPE_SELECT'),
+    'RUSH_MODE': (False, "Slow down the polling of the audience's phones while the server is swamped (e.g. the signup rush)"),
 }
 
-CONSTANCE_BACKEND = 'constance.backends.redisd.RedisBackend'
+CONSTANCE_BACKEND = 'twist.constance_backend.SnapshotRedisBackend'
 CONSTANCE_REDIS_CONNECTION = {'host': 'redis'}  # Connect to the docker container
 
 
@@ -131,6 +142,7 @@ DBBACKUP_STORAGE_OPTIONS = {'location': './db_backups'}
 
 MIDDLEWARE = [
     'song_signup.middleware.timezone_middleware.TimezoneMiddleware',
+    'song_signup.middleware.config_snapshot_middleware.ConfigSnapshotMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -225,6 +237,26 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TASK_SERIALIZER = 'json'
 
+REDIS_HOST = 'redis'  # Docker container
+REDIS_DB = 0
+
+# Seconds to wait after a signup/login/logout before recalculating the lineup, so that a burst of them is folded into a
+# single recalculation run by the celery worker. 0 recalculates as part of the request itself.
+LINEUP_RECALC_DEBOUNCE = float(os.environ.get('LINEUP_RECALC_DEBOUNCE', 0))
+
+# Seconds to keep the results of a lyrics search (Serper is paid per search), and the shorter time to remember that a
+# search found nothing - the site may have the lyrics later.
+SERPER_CACHE_TIMEOUT = int(os.environ.get('SERPER_CACHE_TIMEOUT', 60 * 60 * 24 * 30))
+SERPER_EMPTY_CACHE_TIMEOUT = int(os.environ.get('SERPER_EMPTY_CACHE_TIMEOUT', 60 * 60 * 24))
+
+# The lyrics parsed from a fetched page are used without a request for PAGE_CACHE_FRESH seconds, and revalidated with
+# a conditional request after that. They're dropped after PAGE_CACHE_TIMEOUT.
+# Only the lyrics and the page's validators are kept (not the page), in the Redis that is also the celery broker:
+# a few KB per page, up to 3 pages per site for each song searched - about 100KB per song, so even a few hundred
+# songs searched within PAGE_CACHE_TIMEOUT stay within tens of MB.
+PAGE_CACHE_FRESH = int(os.environ.get('PAGE_CACHE_FRESH', 60 * 60 * 24 * 7))
+PAGE_CACHE_TIMEOUT = int(os.environ.get('PAGE_CACHE_TIMEOUT', 60 * 60 * 24 * 30))
+
 
 try:
     from .local_settings import *
@@ -1,4 +1,15 @@
 import re
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from logging import getLogger
+
+from django.conf import settings
+from django.db import connection, transaction
+from redis import Redis
+
+logger = getLogger(__name__)
+
 
 def is_hebrew(s):
     """Return true if there's at list one hebrew char in the string"""
@@ -12,3 +23,32 @@ def format_commas(names: list):
         return names[0]
     else:
         return f"{', '.join(names[:-1])} and {names[-1]}"
+
+
+@lru_cache(maxsize=None)
+def get_redis():
+    """Return a Redis client shared by the whole process (connections are pooled and opened lazily)"""
+    return Redis(host=settings.REDIS_HOST, db=settings.REDIS_DB)
+
+
+@contextmanager
+def advisory_lock(name):
+    """
+    Run the block in a transaction that holds a Postgres advisory lock on `name`.
+    Only other holders of the same lock wait for it - unlike row locks, it doesn't block unrelated writes to the
+    tables the block touches. The lock is released when the transaction ends, so if this is nested in another atomic
+    block, it's held until the outer one commits.
+    Logs how long we waited for the lock and how long we held it, to keep an eye on contention.
+    """
+    requested_at = time.monotonic()
+    acquired_at = None
+    try:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [name])
+            acquired_at = time.monotonic()
+            yield
+    finally:
+        if acquired_at is not None:
+            logger.info(f"Advisory lock {name}: waited {(acquired_at - requested_at) * 1000:.1f}ms, "
+                        f"held {(time.monotonic() - acquired_at) * 1000:.1f}ms")